@@ -0,0 +1,291 @@
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Optional, Tuple
+
+import numpy as np
+from PyQt5.QtCore import QThread, pyqtSignal
+
+from waveform import Waveform
+
+
+class FrameRingBuffer:
+    """Fixed-capacity, thread-safe ring of preallocated frame arrays.
+    
+    Frames are copied into preallocated slots by the producer and out again
+    by the consumer, so no arrays are allocated per frame. When the ring is
+    full the policy decides what happens to a new frame:
+    
+    - "block": the producer waits for a free slot (back-pressure)
+    - "drop_oldest": the oldest unread frame is overwritten
+    - "drop_newest": the new frame is discarded
+    """
+    
+    POLICIES = ("block", "drop_oldest", "drop_newest")
+    
+    def __init__(self, capacity: int, shape: Tuple[int, ...], dtype=np.float64,
+                 policy: str = "block"):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown policy {policy!r}, expected one of {self.POLICIES}")
+        self.capacity = capacity
+        self.policy = policy
+        self.frames = np.empty((capacity,) + tuple(shape), dtype=dtype)
+        self.meta: list = [None] * capacity
+        self.dropped = 0
+        self._head = 0  # Next slot to read
+        self._count = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.frames.shape[1:]
+        
+    @property
+    def closed(self) -> bool:
+        return self._closed
+        
+    def __len__(self) -> int:
+        with self._lock:
+            return self._count
+            
+    def put(self, frame: np.ndarray, meta: Any = None, timeout: Optional[float] = None) -> bool:
+        """Copy a frame into the ring.
+        
+        Returns:
+            False if the frame was dropped, or the ring is closed, or the
+            "block" policy timed out waiting for a free slot
+        """
+        with self._not_full:
+            if self._count == self.capacity and not self._closed:
+                if self.policy == "drop_newest":
+                    self.dropped += 1
+                    return False
+                if self.policy == "drop_oldest":
+                    self._head = (self._head + 1) % self.capacity
+                    self._count -= 1
+                    self.dropped += 1
+                elif not self._not_full.wait_for(
+                        lambda: self._count < self.capacity or self._closed, timeout):
+                    return False
+            if self._closed:
+                return False
+                
+            slot = (self._head + self._count) % self.capacity
+            np.copyto(self.frames[slot], frame)
+            self.meta[slot] = meta
+            self._count += 1
+            self._not_empty.notify()
+            return True
+            
+    def get(self, timeout: Optional[float] = None,
+            out: Optional[np.ndarray] = None) -> Optional[Tuple[np.ndarray, Any]]:
+        """Take the oldest frame out of the ring.
+        
+        Args:
+            timeout: Seconds to wait for a frame; 0 returns immediately
+            out: Array to copy the frame into; allocated if None
+            
+        Returns:
+            Tuple of (frame, meta), or None if no frame became available
+        """
+        with self._not_empty:
+            if not self._not_empty.wait_for(lambda: self._count > 0 or self._closed, timeout):
+                return None
+            if self._count == 0:
+                return None
+                
+            slot = self._head
+            if out is None:
+                out = self.frames[slot].copy()
+            else:
+                np.copyto(out, self.frames[slot])
+            meta, self.meta[slot] = self.meta[slot], None
+            self._head = (self._head + 1) % self.capacity
+            self._count -= 1
+            self._not_full.notify_all()
+            return out, meta
+            
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every frame has been taken out of the ring.
+        
+        Returns:
+            False if the timeout expired first
+        """
+        with self._not_full:
+            return self._not_full.wait_for(lambda: self._count == 0 or self._closed, timeout)
+            
+    def close(self):
+        """Wake up all waiting producers and consumers; later puts are refused."""
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+
+
+class AcquisitionWorker(QThread):
+    """Dedicated thread that owns all I/O of one ScopeController session.
+    
+    Jobs are run one at a time in submission order, so the VISA session is
+    never used from two threads. Acquired frames are pushed into a
+    FrameRingBuffer, created on the first frame and sized from it, and
+    announced with the ``acquired`` signal; the GUI and writers drain the
+    ring at their own pace.
+    """
+    
+    acquired = pyqtSignal(object)  # Metadata of the frame just pushed
+    failed = pyqtSignal(str, object)  # Error message and job metadata
+    connected = pyqtSignal(bool, str)  # Result of connect_scope() and its error message
+    
+    def __init__(self, scope, capacity: int = 8, policy: str = "block",
+                 drain_timeout: float = 5.0, parent=None):
+        """Initialize the worker.
+        
+        Args:
+            scope: ScopeController whose session this thread owns
+            capacity: Number of frames the ring buffer holds
+            policy: FrameRingBuffer policy when the consumers fall behind
+            drain_timeout: Seconds to wait for the consumers to take the
+                frames of the old shape out of the ring when the record
+                shape changes
+        """
+        super().__init__(parent)
+        self.scope = scope
+        self.capacity = capacity
+        self.policy = policy
+        self.drain_timeout = drain_timeout
+        self.ring: Optional[FrameRingBuffer] = None
+        self.logger = logging.getLogger(__name__)
+        self._jobs: "queue.Queue[Optional[Tuple[Callable, Any]]]" = queue.Queue()
+        
+    def submit(self, func: Callable, *args, **kwargs):
+        """Run func(*args, **kwargs) on the worker thread; errors emit ``failed``."""
+        self._jobs.put((lambda: func(*args, **kwargs), None))
+        
+    def connect_scope(self, *args, **kwargs):
+        """Run ScopeController.connect(*args, **kwargs) on the worker thread.
+        
+        Connecting opens the session this thread owns, so it is queued like
+        every other scope job; the result is announced with ``connected``.
+        """
+        def job():
+            try:
+                result = self.scope.connect(*args, **kwargs)
+            except Exception as e:
+                self.connected.emit(False, str(e))
+                return
+            self.connected.emit(bool(result), "")
+            
+        self._jobs.put((job, None))
+        
+    def request_acquisition(self, acquire: Callable[[], Waveform], meta: Optional[dict] = None,
+                            analyze: Optional[Callable[[Waveform], Any]] = None,
+                            use_ring: bool = True, lossless: bool = False):
+        """Queue an acquisition.
+        
+        Args:
+            acquire: Called on the worker thread; returns a Waveform like
+                ScopeController.acquire_channels
+            meta: Passed along with the frame; the waveform's ``timebase``
+                and ``scale`` and the acquisition ``timestamp`` are added to it
+            analyze: Optional function run on the worker thread right after
+                the waveform is decoded; its result is added to meta as
+                ``features``
+            use_ring: If False, the waveform is not copied into the ring
+                buffer but passed in meta as ``waveform``, e.g. when it is a
+                view on a memory-mapped scan file already
+            lossless: The frame must not be dropped, e.g. a scan point the
+                scan waits for
+                
+        Raises:
+            ValueError: If lossless and the ring's policy drops frames
+        """
+        if lossless and use_ring and self.policy != "block":
+            raise ValueError(f"The {self.policy!r} ring buffer policy may drop frames")
+        meta = dict(meta or {})
+        
+        def job():
+            waveform = acquire()
+            meta["timestamp"] = time.time()
+            if waveform.n_samples == 0:
+                raise RuntimeError("Waveform acquisition failed")
+            meta["timebase"] = waveform.timebase
+            meta["scale"] = waveform.scale
+            if analyze is not None:
+                meta["features"] = analyze(waveform)
+            if not use_ring:
+                meta["waveform"] = waveform
+                self.acquired.emit(meta)
+                return
+                
+            frame = waveform.voltages
+            if self.ring is not None and self.ring.shape != frame.shape:
+                # Let the consumers finish the frames of the old shape first,
+                # but do not hang the thread, and so stop(), on them
+                if not self.ring.join(self.drain_timeout):
+                    self.ring.close()
+                    self.failed.emit(f"{len(self.ring)} frames were dropped when the record "
+                                     f"shape changed to {frame.shape}", None)
+                self.ring = None
+            if self.ring is None:
+                self.ring = FrameRingBuffer(self.capacity, frame.shape, frame.dtype, self.policy)
+            if not self.ring.put(frame, meta):
+                # Nobody gets this frame; report it so a scan does not wait for it
+                reason = "the acquisition was stopped" if self.ring.closed else "the ring buffer is full"
+                raise RuntimeError(f"Frame dropped, {reason}")
+            self.acquired.emit(meta)
+                
+        self._jobs.put((job, meta))
+        
+    def request_measurement(self, measure: Callable[[], np.ndarray], meta: Optional[dict] = None):
+        """Queue an acquisition that yields scalars only, such as scope measurements.
+        
+        The values bypass the ring buffer: they are added to meta as
+        ``measurements`` and announced with ``acquired``.
+        
+        Args:
+            measure: Called on the worker thread; returns a 1-D array like
+                ScopeController.acquire_measurements
+            meta: Passed along with the values
+        """
+        meta = dict(meta or {})
+        
+        def job():
+            values = measure()
+            if len(values) == 0:
+                raise RuntimeError("Measurement acquisition failed")
+            meta["measurements"] = values
+            self.acquired.emit(meta)
+            
+        self._jobs.put((job, meta))
+        
+    def clear_pending(self):
+        """Drop queued jobs that have not started yet."""
+        try:
+            while True:
+                self._jobs.get_nowait()
+        except queue.Empty:
+            pass
+            
+    def stop(self):
+        """Finish the running job, then end the thread."""
+        self.clear_pending()
+        self._jobs.put(None)
+        if self.ring is not None:
+            self.ring.close()
+        self.wait()
+        
+    def run(self):
+        while True:
+            item = self._jobs.get()
+            if item is None:
+                break
+            job, meta = item
+            try:
+                job()
+            except Exception as e:
+                self.logger.error(f"Acquisition job failed: {str(e)}")
+                self.failed.emit(str(e), meta)
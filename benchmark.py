@@ -0,0 +1,247 @@
+"""Microbenchmarks for the data acquisition hot paths.
+
+Runs without any hardware attached: instrument transfers are replayed
+from memory so only the host-side cost is measured.
+
+Usage:
+    python benchmark.py
+"""
+import os
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+from pyvisa import util
+
+from catalog import Catalog
+from ingest import ingest
+from pulse_features import extract_features
+from scan_file import HEADER_SIZE, ScanFile
+from scope_controller import read_ieee_block, scale_codes
+
+
+class LoopbackResource:
+    """Minimal stand-in for a pyvisa resource that replays one response."""
+
+    def __init__(self, response: bytes, chunk_size: int = 1024 * 1024):
+        self.response = response
+        self.chunk_size = chunk_size
+        self.session = None
+        self.visalib = self
+        self.pos = 0
+
+    def rewind(self):
+        self.pos = 0
+
+    def read(self, session, size):
+        chunk = self.response[self.pos:self.pos + size]
+        self.pos += len(chunk)
+        return chunk, None
+
+    def read_bytes(self, count, break_on_termchar=False):
+        return self.read(None, count)[0]
+
+    @contextmanager
+    def ignore_warning(self, *args):
+        yield
+
+
+def measure(func, repeats: int):
+    """Return (seconds per call, blocks allocated per call, peak bytes allocated per call).
+
+    Memory is traced over one call. The peak counts everything allocated
+    during the call, temporaries included, above what was allocated before
+    it. The blocks are those allocated during the call that are still
+    alive when it returns, its result included.
+    """
+    func()  # warm-up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    elapsed = (time.perf_counter() - start) / repeats
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    baseline, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    result = func()
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    del result
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename")
+                 if stat.count_diff > 0)
+    return elapsed, blocks, peak - baseline
+
+
+def report(name: str, nbytes: int, result):
+    elapsed, blocks, peak = result
+    print(f"  {name:<28s} {elapsed * 1e3:8.2f} ms  {nbytes / elapsed / 1e6:8.1f} MB/s"
+          f"  {blocks:8d} blocks  {peak / 1e6:7.1f} MB peak")
+
+
+def bench_curve_decode(n_samples: int = 1_000_000, repeats: int = 10):
+    """Compare list-based query_binary_values decoding with the block path."""
+    print(f"CURVE? decode, {n_samples} samples")
+    rng = np.random.default_rng(0)
+    codes = rng.integers(-128, 128, n_samples, dtype=np.int8).tobytes()
+    digits = str(len(codes))
+    response = b"#" + str(len(digits)).encode() + digits.encode() + codes + b"\n"
+    xze, xin, ymu, yoff, yze = -1e-6, 1e-10, 4e-3, 0.0, 0.0
+
+    def legacy():
+        raw_data = util.from_ieee_block(response, datatype='b')
+        voltages = np.array(raw_data)
+        times = np.arange(len(voltages)) * xin + xze
+        voltages = voltages * ymu + yze
+        return times, voltages
+
+    resource = LoopbackResource(response)
+    buffer = bytearray()
+
+    def block():
+        nonlocal buffer
+        resource.rewind()
+        view = read_ieee_block(resource, buffer)
+        buffer = view.obj
+        voltages = scale_codes(np.frombuffer(view, dtype=np.int8), ymu, yoff, yze)
+        # Waveform keeps (xze, xin) and computes the time axis only on demand
+        return (xze, xin), voltages
+
+    report("query_binary_values + list", len(codes), measure(legacy, repeats))
+    report("block into buffer", len(codes), measure(block, repeats))
+
+
+def bench_pulse_features(n_waveforms: int = 100_000, n_samples: int = 500, repeats: int = 3):
+    """Throughput of vectorized feature extraction on synthetic TCT pulses."""
+    print(f"Pulse features, {n_waveforms} waveforms x {n_samples} samples")
+    rng = np.random.default_rng(0)
+    xin, xze = 1e-10, -1e-8
+    times = np.arange(n_samples) * xin + xze
+    delay = times - rng.uniform(5e-9, 1e-8, (n_waveforms, 1))
+    amplitude = rng.uniform(0.05, 0.2, (n_waveforms, 1))
+    pulses = amplitude * np.where(delay > 0, -np.expm1(-delay / 1e-9) * np.exp(-delay / 5e-9), 0)
+    voltages = pulses + rng.normal(0, 2e-3, pulses.shape)
+    
+    result = measure(lambda: extract_features(voltages, xin, xze), repeats)
+    report("extract_features", voltages.nbytes, result)
+    print(f"  {n_waveforms / result[0]:,.0f} waveforms/s")
+
+
+def bench_scan_storage(n_points: int = 20, n_samples: int = 100_000):
+    """Disk size and write time of float text CSVs versus raw codes in a scan file."""
+    print(f"Scan storage, {n_points} points x 2 channels x {n_samples} samples")
+    rng = np.random.default_rng(0)
+    codes = rng.integers(-128, 128, (2, n_samples), dtype=np.int8)
+    scale = np.array([[4e-3, 0.0, 0.0], [2e-3, 0.0, 0.0]])
+    volts = (codes - scale[:, 1:2]) * scale[:, 0:1] + scale[:, 2:3]
+    
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        for point in range(n_points):
+            for channel in range(2):
+                np.savetxt(os.path.join(directory, f"point{point}_ch{channel}.csv"), volts[channel],
+                           delimiter=',', header="Voltage (V)")
+        csv_time = time.perf_counter() - start
+        csv_bytes = sum(entry.stat().st_size for entry in os.scandir(directory))
+        
+        start = time.perf_counter()
+        with ScanFile.create(os.path.join(directory, "scan.tctscan"), [1, 3], n_samples,
+                             np.int8, (0.0, 1e-10, 0.0)) as scan:
+            for point in range(n_points):
+                scan.append(codes, (point, 0.0, 0.0), scale)
+        scan_time = time.perf_counter() - start
+        scan_bytes = os.path.getsize(scan.path)
+        
+    for name, elapsed, nbytes in (("CSV text, float volts", csv_time, csv_bytes),
+                                  ("scan file, int8 codes", scan_time, scan_bytes)):
+        print(f"  {name:<28s} {elapsed / n_points * 1e3:8.2f} ms/point  {nbytes / 1e6:8.1f} MB")
+    print(f"  {csv_bytes / scan_bytes:.0f}x smaller, {csv_time / scan_time:.0f}x faster")
+
+
+def bench_scan_compression(n_points: int = 256, n_samples: int = 10_000,
+                           settings=(("zlib", 1), ("zlib", 3), ("zlib", 6), ("zlib", 9),
+                                     ("lzma", 0), ("lzma", 1), ("lzma", 3), ("lzma", 6))):
+    """Compression ratio and write throughput of compressed scan files per codec and level."""
+    print(f"Scan compression, {n_points} points x 2 channels x {n_samples} int8 samples")
+    rng = np.random.default_rng(0)
+    # Noisy baseline of a few codes with one pulse per record, like TCT data
+    t = np.arange(n_samples)
+    pulse = 100 * np.exp(-0.5 * ((t - n_samples // 4) / 20.0) ** 2)
+    codes = np.clip(rng.normal(0, 1.5, (n_points, 2, n_samples)) + pulse, -128, 127).astype(np.int8)
+    raw_bytes = codes.nbytes
+    
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "scan.tctscan")
+        print(f"  {'codec':<12s} {'ratio':>7s} {'MB/s':>8s} {'MB/s 1 thread':>14s}")
+        for codec, level in ((None, 0),) + tuple(settings):
+            rates = []
+            for workers in (None, 1):
+                start = time.perf_counter()
+                with ScanFile.create(path, [1, 3], n_samples, np.int8, (0.0, 1e-10, 0.0),
+                                     compression=codec, level=level, workers=workers) as scan:
+                    for point in range(n_points):
+                        scan.append(codes[point], (point, 0.0, 0.0))
+                rates.append(raw_bytes / (time.perf_counter() - start) / 1e6)
+            ratio = raw_bytes / (os.path.getsize(path) - HEADER_SIZE)
+            name = f"{codec} {level}" if codec else "none"
+            print(f"  {name:<12s} {ratio:7.1f} {rates[0]:8.0f} {rates[1]:14.0f}")
+
+
+def bench_catalog_query(n_records: int = 1_000_000):
+    """Time of a position and time range query on a catalog of n_records waveforms."""
+    print(f"Catalog query, {n_records} records")
+    rng = np.random.default_rng(0)
+    now = time.time()
+    with tempfile.TemporaryDirectory() as directory:
+        with Catalog(os.path.join(directory, "catalog.sqlite")) as catalog:
+            start = time.perf_counter()
+            catalog.add({"scan_id": f"scan_{index // 1000}", "x": float(index % 100), "y": y, "z": 0.0,
+                         "channel": 1, "timestamp": now - 90 * 86400 * index / n_records,
+                         "file": "scan.tctscan", "point": index % 1000}
+                        for index, y in enumerate(rng.uniform(0.0, 10.0, n_records)))
+            insert_time = time.perf_counter() - start
+            
+            start = time.perf_counter()
+            rows = catalog.query(y=(2.0, 2.1), since=now - 7 * 86400)
+            query_time = time.perf_counter() - start
+    print(f"  insert {n_records / insert_time:10.0f} records/s")
+    print(f"  y in [2.0, 2.1] from last week: {len(rows)} records in {query_time * 1e3:.1f} ms")
+
+
+def bench_legacy_ingest(n_acquisitions: int = 500, n_samples: int = 2000):
+    """Reading a directory of two-column waveform CSVs with np.loadtxt versus ingest()."""
+    print(f"Legacy CSV ingest, {n_acquisitions} acquisitions x 2 channels x {n_samples} samples")
+    rng = np.random.default_rng(0)
+    times = np.arange(n_samples) * 4e-9 - 2e-6
+    with tempfile.TemporaryDirectory() as directory:
+        for index in range(n_acquisitions):
+            for channel in (1, 3):
+                volts = rng.integers(-128, 128, n_samples) * 4e-3
+                filename = f"waveform_x{index}_y0.000_z0.000_20240101_120000_ch{channel}.csv"
+                np.savetxt(os.path.join(directory, filename), np.column_stack((times, volts)), delimiter=',',
+                           header=f"Time (s),Voltage (mV)\nAcquired: 20240101_120000\nChannel: {channel}")
+        n_files = 2 * n_acquisitions
+        
+        start = time.perf_counter()
+        for entry in os.scandir(directory):
+            np.loadtxt(entry.path, delimiter=',')
+        loadtxt_time = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        ingest(directory, os.path.join(directory, "ingested.tctscan"))
+        ingest_time = time.perf_counter() - start
+        
+    print(f"  np.loadtxt, one process  {n_files / loadtxt_time:8.0f} files/s")
+    print(f"  ingest()                 {n_files / ingest_time:8.0f} files/s ({os.cpu_count()} CPUs)")
+
+
+if __name__ == "__main__":
+    bench_curve_decode()
+    bench_pulse_features()
+    bench_scan_storage()
+    bench_scan_compression()
+    bench_catalog_query()
+    bench_legacy_ingest()
@@ -0,0 +1,205 @@
+import hashlib
+import json
+import sqlite3
+import time
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from pulse_features import FEATURE_NAMES
+
+# One row per stored record: an acquisition of one channel at one position
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS waveforms (
+    id INTEGER PRIMARY KEY,
+    scan_id TEXT,
+    x REAL NOT NULL,
+    y REAL NOT NULL,
+    z REAL NOT NULL,
+    channel INTEGER NOT NULL,
+    timestamp REAL NOT NULL,
+    settings_hash TEXT,
+    file TEXT NOT NULL,
+    point INTEGER NOT NULL DEFAULT 0,
+    {", ".join(f"{name} REAL" for name in FEATURE_NAMES)}
+);
+CREATE TABLE IF NOT EXISTS settings (
+    hash TEXT PRIMARY KEY,
+    settings TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS waveforms_time ON waveforms (timestamp);
+CREATE INDEX IF NOT EXISTS waveforms_x ON waveforms (x, timestamp);
+CREATE INDEX IF NOT EXISTS waveforms_y ON waveforms (y, timestamp);
+CREATE INDEX IF NOT EXISTS waveforms_z ON waveforms (z, timestamp);
+CREATE INDEX IF NOT EXISTS waveforms_scan ON waveforms (scan_id, point);
+"""
+
+COLUMNS = ("scan_id", "x", "y", "z", "channel", "timestamp", "settings_hash", "file", "point") + FEATURE_NAMES
+
+Range = Tuple[Optional[float], Optional[float]]
+
+
+def settings_hash(settings: Dict[str, Any]) -> str:
+    """Short stable hash of JSON-serializable scope settings; equal settings give equal hashes."""
+    encoded = json.dumps(settings, sort_keys=True, default=str).encode()
+    return hashlib.sha1(encoded).hexdigest()[:16]
+
+
+class Catalog:
+    """SQLite index of every stored waveform record.
+    
+    Each row points at one channel's record: the file it is in and, for a
+    scan file, its point index there. Rows carry the stage position, the
+    acquisition time, a hash of the scope settings (the settings
+    themselves are kept once per hash in their own table) and the pulse
+    features, so most questions about a data directory are answered by
+    an indexed query instead of listing and parsing files. Position and
+    time are indexed; queries with a range on one axis and on time read
+    only the matching rows.
+    
+    The database uses write-ahead logging, so other processes can query
+    it while the acquisition program adds rows.
+    """
+    
+    def __init__(self, path: str):
+        """Open a catalog, creating the database file if needed.
+        
+        Args:
+            path: SQLite database file, e.g. catalog.sqlite in the data directory
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(_SCHEMA)
+        self._known_settings = set()
+        
+    def add_settings(self, settings: Dict[str, Any]) -> str:
+        """Store a set of scope settings once.
+        
+        Returns:
+            Its hash, for the settings_hash of the records taken with it
+        """
+        digest = settings_hash(settings)
+        if digest not in self._known_settings:
+            self.connection.execute("INSERT OR IGNORE INTO settings (hash, settings) VALUES (?, ?)",
+                                    (digest, json.dumps(settings, sort_keys=True, default=str)))
+            self._known_settings.add(digest)
+        return digest
+        
+    def settings(self, digest: str) -> Optional[Dict[str, Any]]:
+        """Scope settings stored under a hash."""
+        row = self.connection.execute("SELECT settings FROM settings WHERE hash = ?", (digest,)).fetchone()
+        return json.loads(row["settings"]) if row else None
+        
+    def add(self, records: Iterable[Dict[str, Any]]) -> int:
+        """Insert records in one transaction.
+        
+        Args:
+            records: Dicts keyed by COLUMNS; missing columns are NULL
+            
+        Returns:
+            Number of records added
+        """
+        placeholders = ", ".join("?" for _ in COLUMNS)
+        with self.connection:
+            cursor = self.connection.executemany(
+                f"INSERT INTO waveforms ({', '.join(COLUMNS)}) VALUES ({placeholders})",
+                (tuple(record.get(column) for column in COLUMNS) for record in records))
+        return cursor.rowcount
+        
+    def add_acquisition(self, file: str, position: Sequence[float], channels: Sequence[int],
+                        timestamp: Optional[float] = None, scan_id: Optional[str] = None,
+                        point: int = 0, settings: Optional[Dict[str, Any]] = None,
+                        features: Optional[Dict[str, float]] = None) -> int:
+        """Record the channels of one acquisition.
+        
+        Args:
+            file: File the records are stored in
+            position: Stage (x, y, z)
+            channels: Channel numbers of the records
+            timestamp: Acquisition time in seconds since the epoch; now if None
+            scan_id: Scan the acquisition belongs to, None for a single one
+            point: Point index within a scan file
+            settings: Scope settings; stored once and referenced by hash
+            features: Pulse features keyed "ch{channel}_{name}", as in the
+                scan feature tables
+                
+        Returns:
+            Number of records added
+        """
+        digest = self.add_settings(settings) if settings is not None else None
+        x, y, z = position
+        features = features or {}
+        timestamp = time.time() if timestamp is None else timestamp
+        return self.add(dict({name: features.get(f"ch{channel}_{name}") for name in FEATURE_NAMES},
+                             scan_id=scan_id, x=x, y=y, z=z, channel=channel, timestamp=timestamp,
+                             settings_hash=digest, file=file, point=point)
+                        for channel in channels)
+                        
+    def add_scan_file(self, scan, scan_id: Optional[str] = None) -> int:
+        """Record every point of an existing ScanFile, e.g. one written before the catalog existed.
+        
+        Returns:
+            Number of records added
+        """
+        digest = self.add_settings(dict(scan.metadata, timebase=scan.timebase))
+        records = []
+        for index, point in enumerate(scan.points()):
+            x, y, z = (float(value) for value in point["position"])
+            records += [dict(scan_id=scan_id or scan.path, x=x, y=y, z=z, channel=channel,
+                             timestamp=float(point["timestamp"]), settings_hash=digest,
+                             file=scan.path, point=index)
+                        for channel in scan.channels]
+        return self.add(records)
+        
+    def query(self, x: Optional[Range] = None, y: Optional[Range] = None, z: Optional[Range] = None,
+              since: Optional[float] = None, until: Optional[float] = None,
+              channel: Optional[int] = None, scan_id: Optional[str] = None,
+              limit: Optional[int] = None) -> List[sqlite3.Row]:
+        """Find records by position, time, channel and scan.
+        
+        Args:
+            x, y, z: Inclusive (low, high) ranges; None on either side is open
+            since, until: Inclusive time range in seconds since the epoch
+            channel: Only this channel
+            scan_id: Only this scan
+            limit: Most rows returned
+            
+        Returns:
+            Rows in time order, addressable by column name
+        """
+        conditions, parameters = [], []
+        for column, bounds in (("x", x), ("y", y), ("z", z), ("timestamp", (since, until))):
+            if bounds is None:
+                continue
+            low, high = bounds
+            if low is not None:
+                conditions.append(f"{column} >= ?")
+                parameters.append(low)
+            if high is not None:
+                conditions.append(f"{column} <= ?")
+                parameters.append(high)
+        for column, value in (("channel", channel), ("scan_id", scan_id)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                parameters.append(value)
+                
+        sql = "SELECT * FROM waveforms"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY timestamp"
+        if limit is not None:
+            sql += " LIMIT ?"
+            parameters.append(limit)
+        return self.connection.execute(sql, parameters).fetchall()
+        
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM waveforms").fetchone()[0]
+        
+    def close(self):
+        self.connection.close()
+        
+    def __enter__(self) -> "Catalog":
+        return self
+        
+    def __exit__(self, *exc_info):
+        self.close()
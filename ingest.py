@@ -0,0 +1,216 @@
+"""Pack directories of per-waveform CSV files into scan files.
+
+Reads the files written by ScopeController.save_waveform/write_waveform,
+named ``waveform_x{x}_y{y:.3f}_z{z:.3f}_{timestamp}_ch{channel}.csv``.
+Both formats are understood: the old one with time and voltage columns
+and the current one with only voltages and the time axis in the header.
+The time axis is stored once per output file instead of once per record.
+
+Usage:
+    python ingest.py DATA_DIRECTORY [-o scan.tctscan] [--catalog catalog.sqlite]
+"""
+import argparse
+import io
+import logging
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from catalog import Catalog
+from scan_file import ScanFile
+
+try:
+    import pandas
+except ImportError:  # NumPy's text parser is used instead
+    pandas = None
+
+FILENAME_PATTERN = re.compile(r"waveform_x(-?[\d.]+)_y(-?[\d.]+)_z(-?[\d.]+)_(\d{8}_\d{6})_ch(\d+)\.csv$")
+
+
+class LegacyAcquisition(NamedTuple):
+    """The per-channel CSV files of one acquisition."""
+    position: Tuple[float, float, float]
+    timestamp: float  # Seconds since the epoch, from the filename
+    files: Dict[int, str]  # Path per channel number
+
+
+def parse_filename(name: str) -> Optional[Tuple[Tuple[float, float, float], float, int]]:
+    """Position, timestamp and channel encoded in a waveform filename, None for other files."""
+    match = FILENAME_PATTERN.match(name)
+    if match is None:
+        return None
+    x, y, z, timestamp, channel = match.groups()
+    seconds = datetime.strptime(timestamp, "%Y%m%d_%H%M%S").timestamp()
+    return (float(x), float(y), float(z)), seconds, int(channel)
+
+
+def find_acquisitions(directory: str) -> List[LegacyAcquisition]:
+    """Group the waveform files of a directory by acquisition, in time order."""
+    acquisitions: Dict[tuple, LegacyAcquisition] = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            parsed = parse_filename(entry.name)
+            if parsed is None:
+                continue
+            position, timestamp, channel = parsed
+            key = (position, timestamp)
+            if key not in acquisitions:
+                acquisitions[key] = LegacyAcquisition(position, timestamp, {})
+            acquisitions[key].files[channel] = entry.path
+    return sorted(acquisitions.values(), key=lambda acquisition: (acquisition.timestamp, acquisition.position))
+
+
+def _parse_column(body: bytes, n_columns: int, column: int) -> np.ndarray:
+    """One column of comma-separated numbers, with the pandas C parser if available."""
+    if pandas is not None:
+        frame = pandas.read_csv(io.BytesIO(body), header=None, usecols=[column], dtype=np.float64,
+                                engine="c")
+        return frame.to_numpy().ravel()
+    # Only the wanted column's fields are converted to numbers
+    fields = body.replace(b",", b" ").split()
+    return np.array(fields[column::n_columns], dtype=np.float64)
+
+
+def read_waveform_csv(path: str, dtype=np.float32) -> Tuple[np.ndarray, Tuple[float, float, float]]:
+    """Load a waveform CSV of either format.
+    
+    Only the voltage column is converted; the time axis of a two-column
+    file is taken from its first and last rows.
+    
+    Returns:
+        (voltages, (xze, xin, pt_off))
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+        
+    header = {}
+    start = 0
+    while data.startswith(b"#", start):
+        end = data.index(b"\n", start)
+        key, _, value = data[start + 1:end].decode().strip().partition(": ")
+        header[key] = value
+        start = end + 1
+    body = data[start:]
+    
+    if "XIncr (s)" in header:
+        voltages = _parse_column(body, 1, 0)
+        timebase = (float(header["XZero (s)"]), float(header["XIncr (s)"]), float(header.get("PtOff", 0.0)))
+    else:
+        # The old header says mV, but the column holds volts
+        voltages = _parse_column(body, 2, 1)
+        first = float(body[:body.index(b",")])
+        last_line = body.rstrip().rsplit(b"\n", 1)[-1]
+        last = float(last_line[:last_line.index(b",")])
+        timebase = (first, (last - first) / max(len(voltages) - 1, 1), 0.0)
+    return voltages.astype(dtype), timebase
+
+
+def _read_acquisition(files: List[str], dtype) -> List[Tuple[np.ndarray, Tuple[float, float, float]]]:
+    """Runs in the worker processes."""
+    return [read_waveform_csv(path, dtype) for path in files]
+
+
+def _timebase_key(n_samples: int, timebase: Tuple[float, float, float]) -> tuple:
+    # Time axes equal to 9 significant digits are the same
+    return (n_samples,) + tuple(float(f"{value:.9e}") for value in timebase)
+
+
+def ingest(directory: str, output: Optional[str] = None, workers: Optional[int] = None,
+           dtype=np.float32, compression: Optional[str] = None,
+           catalog: Optional[str] = None) -> List[str]:
+    """Pack all waveform CSVs of a directory into scan files.
+    
+    The files are parsed by a pool of worker processes; each acquisition
+    (all channels of one position and time) becomes one scan point, in
+    time order. Records with another length or time axis than the first
+    go to an extra scan file, named with a suffix _1, _2, ...; a channel
+    whose time axis differs from the others of its acquisition goes
+    there too, with NaN in place of the other channels.
+    
+    Args:
+        directory: Directory with waveform_*.csv files
+        output: Scan file to write; by default ingested.tctscan in directory
+        workers: Parser processes, by default one per CPU
+        dtype: Sample dtype to store the volts as
+        compression: Optional codec of the scan files, see scan_file.CODECS
+        catalog: Optional catalog database to record the points in
+        
+    Returns:
+        Paths of the scan files written
+    """
+    logger = logging.getLogger(__name__)
+    output = output or os.path.join(directory, "ingested.tctscan")
+    acquisitions = find_acquisitions(directory)
+    channels = sorted({channel for acquisition in acquisitions for channel in acquisition.files})
+    logger.info(f"Ingesting {len(acquisitions)} acquisitions of channels {channels} from {directory}")
+    
+    scans: Dict[tuple, ScanFile] = {}
+    start = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(workers) as pool:
+            file_lists = [[acquisition.files[channel] for channel in channels if channel in acquisition.files]
+                          for acquisition in acquisitions]
+            results = pool.map(partial(_read_acquisition, dtype=dtype), file_lists, chunksize=16)
+            for acquisition, records in zip(acquisitions, results):
+                present = [channel for channel in channels if channel in acquisition.files]
+                if len(present) < len(channels):
+                    logger.warning(f"Acquisition at {acquisition.position} has only channels {present}")
+                    
+                # Channels are grouped by time axis; usually there is one group
+                groups: Dict[tuple, Tuple[np.ndarray, Tuple[float, float, float]]] = {}
+                for channel, (voltages, timebase) in zip(present, records):
+                    key = _timebase_key(len(voltages), timebase)
+                    if key not in groups:
+                        if groups:
+                            logger.warning(f"{acquisition.files[channel]} has another time axis than "
+                                           f"{acquisition.files[present[0]]}; storing it with the "
+                                           f"records of its own")
+                        groups[key] = (np.full((len(channels), len(voltages)), np.nan, dtype=dtype), timebase)
+                    groups[key][0][channels.index(channel)] = voltages
+                    
+                for key, (codes, timebase) in groups.items():
+                    if key not in scans:
+                        stem, extension = os.path.splitext(output)
+                        path = output if not scans else f"{stem}_{len(scans)}{extension}"
+                        scans[key] = ScanFile.create(path, channels, codes.shape[1], dtype, timebase,
+                                                     compression=compression,
+                                                     metadata={"source": os.path.abspath(directory)})
+                    scans[key].append(codes, acquisition.position, timestamp=acquisition.timestamp)
+    finally:
+        for scan in scans.values():
+            scan.close()
+            
+    elapsed = time.perf_counter() - start
+    logger.info(f"Packed {len(acquisitions)} acquisitions into {len(scans)} scan files in {elapsed:.1f} s")
+    
+    if catalog is not None:
+        with Catalog(catalog) as index:
+            for scan in scans.values():
+                with ScanFile.open(scan.path) as stored:
+                    index.add_scan_file(stored, os.path.splitext(os.path.basename(scan.path))[0])
+    return [scan.path for scan in scans.values()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack a directory of waveform CSV files into scan files.")
+    parser.add_argument("directory", help="Directory with waveform_*.csv files")
+    parser.add_argument("-o", "--output", help="Scan file to write (default: DIRECTORY/ingested.tctscan)")
+    parser.add_argument("-j", "--workers", type=int, help="Parser processes (default: one per CPU)")
+    parser.add_argument("--compression", choices=["zlib", "lzma"], help="Compress the scan file chunks")
+    parser.add_argument("--catalog", help="Catalog database to record the ingested points in")
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    for path in ingest(args.directory, args.output, args.workers, compression=args.compression,
+                       catalog=args.catalog):
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
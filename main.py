@@ -32,7 +32,8 @@ try:
         from PyQt5 import QtWidgets, QtCore
         logging.info("Successfully imported PyQt5")
         from PyQt5.QtWidgets import QApplication, QMainWindow, QPushButton, QVBoxLayout, QWidget, QLabel, QLineEdit, QGridLayout, QMessageBox
-        from PyQt5.QtCore import Qt
+        from PyQt5.QtWidgets import QGroupBox, QSpinBox, QDoubleSpinBox, QCheckBox, QComboBox, QFileDialog
+        from PyQt5.QtCore import Qt, QTimer, pyqtSlot
         logging.info("Successfully imported PyQt5 widgets")
     except Exception as e:
         logging.error(f"Failed to import PyQt5: {str(e)}\n{traceback.format_exc()}")
@@ -59,12 +60,30 @@ try:
         logging.error(f"Failed to import matplotlib: {str(e)}\n{traceback.format_exc()}")
 
     # Rest of your imports
+    from datetime import datetime
+    import queue
+    import numpy as np
+    import yaml
     import matplotlib.pyplot as plt
-    from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
     
     from scope_controller import ScopeController
     from stage_controller import StageController
+    from acquisition_worker import AcquisitionWorker
+    from waveform import Waveform
+    from pulse_features import FEATURE_NAMES, FeatureTable, waveform_features
+    from plot_widgets import FeatureMapWidget, ScanGrid, WaveformPlotWidget
+    from scan_file import ScanFile, ScanWriter
+    from catalog import Catalog
+    from waveform_stats import WaveformAccumulator
+
+    # Scope measurements stored per channel in the measurements-only scan mode
+    SURVEY_MEASUREMENTS = ("AMPLITUDE", "AREA", "RISE")
+
+    # Scan file storage modes
+    STORAGE_PREALLOCATED = "Preallocated (memory-mapped)"
+    STORAGE_CHUNKED = "Chunked (background writer)"
+    STORAGE_COMPRESSED = "Compressed, zlib (background writer)"
 
     class MainWindow(QMainWindow):
         """Main window for TCT control application."""
@@ -84,6 +103,21 @@ try:
             self.scope = ScopeController()
             self.connected = False
             self.scanning = False
+            self.measurement_file = None
+            self.feature_table = None  # Per-position pulse features of the current scan
+            self.scan_grid = None
+            self.scan_writer = None  # Writes all waveforms of the current scan to one file
+            self.scan_store = None  # Preallocated scan file; only used on the acquisition thread
+            self.scan_id = None
+            self.scan_path = None  # Scan file of the current scan
+            self.catalog = None  # Index of all waveforms saved in the data directory
+            
+            # All scope I/O runs on the acquisition thread
+            self.acquisition = AcquisitionWorker(self.scope)
+            self.acquisition.acquired.connect(self._on_frame_acquired)
+            self.acquisition.failed.connect(self._on_acquisition_failed)
+            self.acquisition.connected.connect(self._on_scope_connected)
+            self.acquisition.start()
             
             self.setup_ui()
             
@@ -94,6 +128,7 @@ try:
             # Initialize state
             self.current_scan_position = 0
             self.scan_timer = QTimer()
+            self.scan_timer.setSingleShot(True)  # Restarted once each point is acquired
             self.scan_timer.timeout.connect(self.scan_step)
             
         def setup_ui(self):
@@ -113,14 +148,30 @@ try:
             right_panel = QWidget()
             right_layout = QVBoxLayout(right_panel)
             
-            # Create matplotlib figure
-            self.figure = Figure()
-            self.canvas = FigureCanvas(self.figure)
-            self.ax = self.figure.add_subplot(111)
-            self.ax.set_xlabel("Time (s)")
-            self.ax.set_ylabel("Voltage (V)")
-            self.ax.grid(True)
-            right_layout.addWidget(self.canvas)
+            # Waveform plot; refreshed at its own rate, zoom redecimates the record
+            self.waveform_plot = WaveformPlotWidget(right_panel)
+            right_layout.addWidget(NavigationToolbar(self.waveform_plot, right_panel))
+            right_layout.addWidget(self.waveform_plot)
+            
+            # Live map of one pulse feature over the scanned positions
+            map_controls = QGridLayout()
+            map_controls.addWidget(QLabel("Map:"), 0, 0)
+            self.map_feature = QComboBox()
+            self.map_feature.addItems([f"ch{channel}_{name}" for channel in (1, 3)
+                                       for name in FEATURE_NAMES + ("frame_spread",)])
+            self.map_feature.setCurrentText("ch1_charge")
+            self.map_feature.currentTextChanged.connect(self.update_feature_map)
+            map_controls.addWidget(self.map_feature, 0, 1)
+            
+            map_controls.addWidget(QLabel("Axes:"), 0, 2)
+            self.map_axes = QComboBox()
+            self.map_axes.addItems(["X-Y", "X-Z", "Y-Z"])
+            self.map_axes.currentTextChanged.connect(self.reset_feature_map)
+            map_controls.addWidget(self.map_axes, 0, 3)
+            right_layout.addLayout(map_controls)
+            
+            self.feature_map = FeatureMapWidget(right_panel)
+            right_layout.addWidget(self.feature_map)
             
             layout.addWidget(right_panel)
             
@@ -238,14 +289,41 @@ try:
             self.ch3_trigger.setRange(-10000, 10000)  # ±10V in mV
             layout.addWidget(self.ch3_trigger, 2, 3)
             
+            # Scope-side averaging per acquisition
+            layout.addWidget(QLabel("Averages:"), 3, 0)
+            self.num_averages = QSpinBox()
+            self.num_averages.setRange(1, 10000)
+            self.num_averages.setValue(1)  # Default no averaging
+            layout.addWidget(self.num_averages, 3, 1)
+            
+            # FastFrame: triggers captured per acquisition and averaged here
+            layout.addWidget(QLabel("Frames per point:"), 3, 2)
+            self.num_frames = QSpinBox()
+            self.num_frames.setRange(1, 10000)
+            self.num_frames.setValue(1)  # Default no FastFrame
+            layout.addWidget(self.num_frames, 3, 3)
+            
             # Auto-scale buttons
             auto_scale_ch1 = QPushButton("Auto Scale Ch1")
             auto_scale_ch1.clicked.connect(lambda: self.auto_scale(1))
-            layout.addWidget(auto_scale_ch1, 3, 0, 1, 2)
+            layout.addWidget(auto_scale_ch1, 4, 0, 1, 2)
             
             auto_scale_ch3 = QPushButton("Auto Scale Ch3")
             auto_scale_ch3.clicked.connect(lambda: self.auto_scale(3))
-            layout.addWidget(auto_scale_ch3, 3, 2, 1, 2)
+            layout.addWidget(auto_scale_ch3, 4, 2, 1, 2)
+            
+            # Acquisition window: transfer only the samples around the pulse
+            auto_window_btn = QPushButton("Find Pulse Window")
+            auto_window_btn.clicked.connect(self.find_pulse_window)
+            layout.addWidget(auto_window_btn, 5, 0, 1, 2)
+            
+            full_window_btn = QPushButton("Full Record")
+            full_window_btn.clicked.connect(lambda: self.acquisition.submit(self.scope.set_acquisition_window))
+            layout.addWidget(full_window_btn, 5, 2, 1, 2)
+            
+            auto_horizontal_btn = QPushButton("Auto Horizontal")
+            auto_horizontal_btn.clicked.connect(self.auto_horizontal)
+            layout.addWidget(auto_horizontal_btn, 6, 0, 1, 4)
             
             group.setLayout(layout)
             parent_layout.addWidget(group)
@@ -286,6 +364,17 @@ try:
             self.scan_delay.setValue(1.0)
             layout.addWidget(self.scan_delay, 3, 1)
             
+            # Survey mode: store scope measurements per position, no waveforms
+            self.measure_only = QCheckBox("Measurements only (amplitude, area, rise)")
+            layout.addWidget(self.measure_only, 5, 0, 1, 2)
+            
+            # Preallocated files are sized from the scan plan and the scope
+            # transfers are decoded straight into them
+            layout.addWidget(QLabel("Scan Storage:"), 6, 0)
+            self.scan_storage = QComboBox()
+            self.scan_storage.addItems([STORAGE_PREALLOCATED, STORAGE_CHUNKED, STORAGE_COMPRESSED])
+            layout.addWidget(self.scan_storage, 6, 1)
+            
             # Scan controls
             self.start_scan_btn = QPushButton("Start Scan")
             self.start_scan_btn.clicked.connect(self.start_scan)
@@ -313,7 +402,7 @@ try:
             
             # Single acquisition button
             self.acquire_btn = QPushButton("Single Acquisition")
-            self.acquire_btn.clicked.connect(self.acquire_data)
+            self.acquire_btn.clicked.connect(lambda: self.acquire_data())
             layout.addWidget(self.acquire_btn, 1, 0, 1, 3)
             
             group.setLayout(layout)
@@ -407,46 +496,18 @@ try:
                     QMessageBox.warning(self, "Connection Error", f"Stage connection error: {str(e)}")
                     return
                     
-                # Connect scope
-                try:
-                    self.logger.info("Attempting to connect to oscilloscope...")
-                    if self.scope.connect():
-                        self.scope_status.setText("Scope: Connected")
-                        self.logger.info("Oscilloscope connected successfully")
-                    else:
-                        error_msg = "Failed to connect to scope.\n\nPlease check:\n"
-                        error_msg += "1. VISA drivers are installed\n"
-                        error_msg += "2. Scope is powered on\n"
-                        error_msg += "3. GPIB cable is connected\n"
-                        error_msg += "4. Scope is set to GPIB address 1\n"
-                        error_msg += "\nTrying to connect using GPIB0::1::INSTR"
-                        self.logger.warning(error_msg)
-                        QMessageBox.warning(self, "Connection Error", error_msg)
-                        self.stage.disconnect()
-                        self.stage_status.setText("Stage: Not Connected")
-                        return
-                except Exception as e:
-                    self.logger.error(f"Scope connection error: {str(e)}")
-                    QMessageBox.warning(self, "Connection Error", f"Scope connection error: {str(e)}")
-                    self.stage.disconnect()
-                    self.stage_status.setText("Stage: Not Connected")
-                    return
-                    
-                self.connected = True
-                self.connect_btn.setText("Disconnect")
-                self.update_position_display()
-                self.logger.info("All devices connected successfully")
-                
-                # Disable port inputs while connected
-                self.x_port.setEnabled(False)
-                self.y_port.setEnabled(False)
-                self.z_port.setEnabled(False)
+                # Connect scope on the acquisition thread, which owns its session;
+                # _on_scope_connected finishes the connection
+                self.logger.info("Attempting to connect to oscilloscope...")
+                self.scope_status.setText("Scope: Connecting...")
+                self.connect_btn.setEnabled(False)
+                self.acquisition.connect_scope()
                 
             else:
                 self.logger.info("Disconnecting devices...")
                 self.stop_scan()  # Stop any ongoing scan
                 self.stage.disconnect()
-                self.scope.disconnect()
+                self.acquisition.submit(self.scope.disconnect)
                 self.stage_status.setText("Stage: Not Connected")
                 self.scope_status.setText("Scope: Not Connected")
                 self.connected = False
@@ -458,6 +519,40 @@ try:
                 self.y_port.setEnabled(True)
                 self.z_port.setEnabled(True)
                 
+        @pyqtSlot(bool, str)
+        def _on_scope_connected(self, success, error):
+            """Finish connect_devices() once the acquisition thread has connected the scope."""
+            self.connect_btn.setEnabled(True)
+            if not success:
+                if error:
+                    self.logger.error(f"Scope connection error: {error}")
+                    QMessageBox.warning(self, "Connection Error", f"Scope connection error: {error}")
+                else:
+                    error_msg = "Failed to connect to scope.\n\nPlease check:\n"
+                    error_msg += "1. VISA drivers are installed\n"
+                    error_msg += "2. Scope is powered on\n"
+                    error_msg += "3. GPIB cable is connected\n"
+                    error_msg += "4. Scope is set to GPIB address 1\n"
+                    error_msg += "\nTrying to connect using GPIB0::1::INSTR"
+                    self.logger.warning(error_msg)
+                    QMessageBox.warning(self, "Connection Error", error_msg)
+                self.stage.disconnect()
+                self.stage_status.setText("Stage: Not Connected")
+                self.scope_status.setText("Scope: Not Connected")
+                return
+                
+            self.scope_status.setText("Scope: Connected")
+            self.logger.info("Oscilloscope connected successfully")
+            self.connected = True
+            self.connect_btn.setText("Disconnect")
+            self.update_position_display()
+            self.logger.info("All devices connected successfully")
+            
+            # Disable port inputs while connected
+            self.x_port.setEnabled(False)
+            self.y_port.setEnabled(False)
+            self.z_port.setEnabled(False)
+                
         def update_position_display(self):
             if self.connected:
                 x, y, z = self.stage.get_position()
@@ -494,10 +589,32 @@ try:
             if not self.connected:
                 return
             
-            self.scope.auto_scale(channel)
+            self.acquisition.submit(self.scope.auto_scale, channel)
             
-        def acquire_data(self):
-            """Acquire data from enabled channels with timeout protection."""
+        @pyqtSlot()
+        def find_pulse_window(self):
+            """Narrow the transferred samples around the pulse of a reference shot."""
+            if not self.connected:
+                return
+            
+            channel = 1 if self.ch1_enable.isChecked() else 3
+            self.acquisition.submit(self.scope.find_acquisition_window, channel)
+            
+        @pyqtSlot()
+        def auto_horizontal(self):
+            """Pick the smallest record length and sample rate that capture the pulse."""
+            if not self.connected:
+                return
+            
+            channel = 1 if self.ch1_enable.isChecked() else 3
+            self.acquisition.submit(self.scope.auto_horizontal, channel)
+            
+        def acquire_data(self, scan: bool = False):
+            """Queue an acquisition of the enabled channels on the acquisition thread.
+            
+            Args:
+                scan: Whether this is a scan point; the scan advances once it is saved
+            """
             if not self.connected or not self.file_path.text():
                 return
             
@@ -507,31 +624,332 @@ try:
                 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
                 base_filename = f"{self.file_path.text()}/waveform_x{x}_y{y:.3f}_z{z:.3f}_{timestamp}"
                 
-                # Acquire from enabled channels with timeout protection
+                channels = []
                 if self.ch1_enable.isChecked():
-                    try:
-                        self.scope.configure_channel(1, self.ch1_scale.value() / 1000.0)  # Convert mV to V
-                        self.scope.set_trigger(1, self.ch1_trigger.value() / 1000.0)  # Convert mV to V
-                        self.scope.save_waveform(1, f"{base_filename}_ch1.csv")
-                    except Exception as e:
-                        self.logger.error(f"Channel 1 acquisition failed: {str(e)}")
-                        raise
-                        
+                    channels.append(1)
                 if self.ch3_enable.isChecked():
-                    try:
-                        self.scope.configure_channel(3, self.ch3_scale.value() / 1000.0)  # Convert mV to V
-                        self.scope.set_trigger(3, self.ch3_trigger.value() / 1000.0)  # Convert mV to V
-                        self.scope.save_waveform(3, f"{base_filename}_ch3.csv")
-                    except Exception as e:
-                        self.logger.error(f"Channel 3 acquisition failed: {str(e)}")
-                        raise
+                    channels.append(3)
+                if not channels:
+                    return
+                    
+                # Read the widgets here, the acquisition itself runs on the worker thread
+                scales = {1: self.ch1_scale.value() / 1000.0, 3: self.ch3_scale.value() / 1000.0}  # Convert mV to V
+                triggers = {1: self.ch1_trigger.value() / 1000.0, 3: self.ch3_trigger.value() / 1000.0}  # Convert mV to V
+                n_average = self.num_averages.value()
+                measure_only = scan and self.measure_only.isChecked()
+                n_frames = 1 if measure_only else self.num_frames.value()
+                
+                def acquire_setup():
+                    # Configure all channels in one message; the first enabled
+                    # channel provides the single shared trigger
+                    with self.scope.command_batch():
+                        for channel in channels:
+                            self.scope.configure_channel(channel, scales[channel])
+                        self.scope.set_trigger(channels[0], triggers[channels[0]])
+                        self.scope.set_fastframe(n_frames if n_frames > 1 else 0)
+                        
+                frame_spread = {}  # Of a FastFrame acquisition, reported with its features
+                
+                def read(out=None):
+                    # Read every enabled channel from the same trigger(s)
+                    if n_frames > 1:
+                        waveform, spread = self._acquire_frames(channels)
+                        frame_spread.update((f"ch{channel}_frame_spread", value)
+                                            for channel, value in zip(channels, spread))
+                        return waveform
+                    return self.scope.acquire_channels(channels, n_average, raw=True, out=out)
+                    
+                def acquire():
+                    acquire_setup()
+                    return read()
+                    
+                preallocated = scan and self.scan_storage.currentText() == STORAGE_PREALLOCATED
+                if preallocated:
+                    scan_path = self.scan_path
+                    capacity = self.num_steps.value()
+                    metadata = self._scan_metadata()
+                    
+                    def acquire():
+                        acquire_setup()
+                        if self.scan_store is None:
+                            # The first point fixes the record format and timebase
+                            waveform = read()
+                            if waveform.n_samples == 0:
+                                return waveform
+                            self.scan_store = ScanFile.create(
+                                scan_path, channels, waveform.n_samples, waveform.voltages.dtype,
+                                waveform.timebase, metadata=metadata, capacity=capacity, overwrite=False)
+                            self.logger.info(f"Writing scan to {scan_path}")
+                            index, codes = self.scan_store.reserve()
+                        else:
+                            index, codes = self.scan_store.reserve()
+                            waveform = read(out=codes)
+                        if waveform.n_samples and waveform.voltages is not codes:
+                            # The first point and FastFrame means were not read into the slot
+                            codes[...] = waveform.voltages
+                            waveform = Waveform(codes, *waveform.timebase, scale=waveform.scale)
+                        if waveform.n_samples:
+                            self.scan_store.commit(index, (x, y, z), waveform.scale)
+                        return waveform
+                        
+                meta = {
+                    'position': (x, y, z),
+                    'base_filename': base_filename,
+                    'channels': channels,
+                    'scan': scan,
+                    'scan_id': self.scan_id if scan else None,
+                    'point': self.current_scan_position if scan else 0,
+                    'settings': {
+                        'channels': channels,
+                        'scales': [scales[channel] for channel in channels],
+                        'trigger': triggers[channels[0]],
+                        'averages': n_average,
+                        'frames': n_frames,
+                    },
+                }
+                
+                if measure_only:
+                    measurements = [(measurement, channel) for channel in channels
+                                    for measurement in SURVEY_MEASUREMENTS]
+                    
+                    def measure():
+                        acquire_setup()
+                        self.scope.configure_measurements(measurements)
+                        return self.scope.acquire_measurements(n_average)
                         
-                self.logger.info(f"Saved waveforms at position X={x}steps, Y={y:.3f}mm, Z={z:.3f}mm")
+                    meta['measurement_names'] = [f"CH{channel} {measurement}"
+                                                 for measurement, channel in measurements]
+                    self.acquisition.request_measurement(measure, meta)
+                else:
+                    def analyze(waveform):
+                        # Features of every channel, computed on the worker thread
+                        features = waveform_features(waveform)
+                        return dict({f"ch{channel}_{name}": float(values[index])
+                                     for name, values in zip(FEATURE_NAMES, features)
+                                     for index, channel in enumerate(channels)}, **frame_spread)
+                                
+                    # Preallocated scan points are in the file already and
+                    # reach the GUI as views of it, not through the ring
+                    self.acquisition.request_acquisition(acquire, meta, analyze if scan else None,
+                                                         use_ring=not preallocated, lossless=scan)
                 
             except Exception as e:
                 self.logger.error(f"Data acquisition failed: {str(e)}")
                 raise
+                
+        def _acquire_frames(self, channels):
+            """Capture one FastFrame sequence and reduce it to one record per channel.
+            
+            Runs on the acquisition thread, with FastFrame enabled. Each
+            channel's frames go through a WaveformAccumulator in one pass.
+            
+            Returns:
+                Tuple of (waveform, spread): the mean frame of every channel as
+                float32 codes with the channels' scaling, and per channel the
+                RMS over the record of the frame-to-frame standard deviation,
+                in volts
+            """
+            records, scale, spread = [], [], []
+            for index, channel in enumerate(channels):
+                # All channels' frames come from the sequence armed for the first
+                frames, _ = self.scope.acquire_fastframe(channel, arm=index == 0)
+                if frames.size == 0:
+                    return Waveform.empty(), []
+                stats = WaveformAccumulator().update(frames)
+                preamble = self.scope.get_preamble(channel)
+                records.append(stats.mean.astype(np.float32))
+                scale.append((preamble.ymu, preamble.yoff, preamble.yze))
+                spread.append(abs(preamble.ymu) * float(np.sqrt(stats.variance().mean())))
+            preamble = self.scope.get_preamble(channels[0])
+            waveform = Waveform(np.stack(records), preamble.xze, preamble.xin, preamble.pt_off, scale=scale)
+            return waveform, spread
+            
+        @pyqtSlot(object)
+        def _on_frame_acquired(self, meta):
+            """Save the frames waiting in the ring buffer and advance the scan."""
+            stale = self._is_stale(meta)
+            if stale:
+                # Acquired while Stop Scan was pressed: its scan file is closed
+                # already and a later scan must not record it
+                self.logger.warning(f"Dropped point {meta['point']} of the stopped scan {meta['scan_id']}")
+            if 'measurements' in meta and not stale:
+                self._save_measurements(meta)
+            if 'waveform' in meta and not stale:
+                self._show_frame(meta['waveform'], meta)
+                self._add_to_catalog(meta, self.scan_path)
+                
+            while True:
+                # The acquisition thread may replace or drop the ring meanwhile
+                ring = self.acquisition.ring
+                item = ring.get(timeout=0) if ring is not None else None
+                if item is None:
+                    break
+                voltages, frame_meta = item
+                if self._is_stale(frame_meta):
+                    continue  # Reported with its own acquired signal
+                waveform = Waveform(voltages, *frame_meta['timebase'], scale=frame_meta['scale'])
+                x, y, z = frame_meta['position']
+                self._show_frame(waveform, frame_meta)
+                try:
+                    if frame_meta['scan']:
+                        self._write_scan_point(waveform, frame_meta)
+                        self._add_to_catalog(frame_meta, self.scan_path)
+                    else:
+                        for index, channel in enumerate(frame_meta['channels']):
+                            filename = f"{frame_meta['base_filename']}_ch{channel}.csv"
+                            self.scope.write_waveform(channel, filename, waveform.channel(index).in_volts())
+                            self._add_to_catalog(frame_meta, filename, [channel])
+                    self.logger.info(f"Saved waveforms at position X={x}steps, Y={y:.3f}mm, Z={z:.3f}mm")
+                except Exception as e:
+                    self._on_acquisition_failed(f"Failed to save waveforms: {str(e)}", frame_meta)
+                    
+            if meta.get('scan') and not self._is_stale(meta):
+                # Check if scan is complete
+                self.current_scan_position += 1
+                if self.current_scan_position >= self.num_steps.value():
+                    self.stop_scan()
+                    QMessageBox.information(self, "Scan Complete", "Scan completed successfully")
+                else:
+                    self.scan_timer.start(int(self.scan_delay.value() * 1000))
+                    
+        def _is_stale(self, meta):
+            """Whether meta is of a scan point that arrived after its scan was stopped."""
+            return bool(meta.get('scan')) and not (self.scanning and meta['scan_id'] == self.scan_id)
+                    
+        def _show_frame(self, waveform, meta):
+            """Plot an acquired waveform and record its scan features."""
+            if 'features' in meta:
+                self._add_features(meta)
+            self.waveform_plot.set_waveform(waveform, [f"CH{channel}" for channel in meta['channels']])
+            
+        def _scan_metadata(self):
+            """Scan settings stored in the scan file header."""
+            return {
+                'axis': self.scan_axis.currentText(),
+                'step': self.step_size.value(),
+                'num_steps': self.num_steps.value(),
+                'averages': self.num_averages.value(),
+                'frames': self.num_frames.value(),
+            }
+            
+        def _write_scan_point(self, waveform, meta):
+            """Queue one scan position's records for the scan file opened by start_scan()."""
+            if self.scan_writer is None:
+                raise IOError(f"Scan file {self.scan_path} is not open")
+            try:
+                # Queued only: the file is written while the stage moves on,
+                # and a full queue must not freeze the GUI thread
+                self.scan_writer.write(waveform.voltages, meta['position'], waveform.scale,
+                                       meta['timestamp'], waveform.timebase, block=False)
+            except queue.Full:
+                raise IOError(f"Scan file writer is {self.scan_writer.pending} points behind, "
+                              f"the disk cannot keep up with the scan")
+            
+        def _close_scan_file(self):
+            """Write the queued points and close the scan file."""
+            if self.scan_writer is None:
+                return
+            try:
+                self.scan_writer.close()
+                scan_file = self.scan_writer.scan
+                if scan_file is not None:
+                    self.logger.info(f"Saved {len(scan_file)} scan points to {scan_file.path}")
+            except Exception as e:
+                self.logger.error(f"Failed to close scan file: {str(e)}")
+            self.scan_writer = None
+            
+        def _add_to_catalog(self, meta, filename, channels=None):
+            """Record saved waveforms in the data directory's catalog."""
+            path = f"{self.file_path.text()}/catalog.sqlite"
+            try:
+                if self.catalog is None or self.catalog.path != path:
+                    if self.catalog is not None:
+                        self.catalog.close()
+                    self.catalog = Catalog(path)
+                self.catalog.add_acquisition(
+                    filename, meta['position'], channels or meta['channels'], meta['timestamp'],
+                    scan_id=meta['scan_id'], point=meta['point'],
+                    settings=dict(meta['settings'], timebase=meta['timebase']),
+                    features=meta.get('features'))
+            except Exception as e:
+                self.logger.error(f"Failed to add waveforms to the catalog: {str(e)}")
             
+        def _close_scan_store(self):
+            """Close the preallocated scan file; runs on the acquisition thread after the scan's last point."""
+            if self.scan_store is None:
+                return
+            try:
+                self.scan_store.close()
+                self.logger.info(f"Saved {len(self.scan_store)} scan points to {self.scan_store.path}")
+            except Exception as e:
+                self.logger.error(f"Failed to close scan file: {str(e)}")
+            self.scan_store = None
+                    
+        def _add_features(self, meta):
+            """Append one scan position's pulse features to the scan's feature table."""
+            x, y, z = meta['position']
+            if self.feature_table is None:
+                columns = ["x", "y", "z"] + [f"ch{channel}_{name}" for channel in meta['channels']
+                                             for name in FEATURE_NAMES]
+                # FastFrame scans add the frame spread of every channel
+                columns += [name for name in meta['features'] if name not in columns]
+                self.feature_table = FeatureTable(columns, capacity=self.num_steps.value())
+            self.feature_table.append(dict(meta['features'], x=x, y=y, z=z))
+            self.feature_map.add_point((x, y, z), meta['features'].get(self.map_feature.currentText(), float('nan')))
+            
+        def reset_feature_map(self):
+            """Allocate the map for the current scan and fill in the points measured so far."""
+            if self.scan_grid is None:
+                return
+            axes = self.map_axes.currentText().lower().split("-")
+            self.feature_map.set_grid(self.scan_grid, axes, self.map_feature.currentText())
+            self.update_feature_map()
+            
+        def update_feature_map(self):
+            """Show another feature of the current scan."""
+            if self.feature_table is not None:
+                self.feature_map.load(self.feature_table, self.map_feature.currentText())
+            
+        def _save_feature_table(self):
+            """Write the scan's feature table next to the waveform files."""
+            if self.feature_table is None or not len(self.feature_table):
+                return
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            filename = f"{self.file_path.text()}/features_{timestamp}.csv"
+            try:
+                self.feature_table.save_csv(filename)
+                self.logger.info(f"Saved scan features to {filename}")
+            except Exception as e:
+                self.logger.error(f"Failed to save scan features: {str(e)}")
+                    
+        def _save_measurements(self, meta):
+            """Append one position's scope measurements to the scan's CSV file."""
+            x, y, z = meta['position']
+            try:
+                if self.measurement_file is None:
+                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                    self.measurement_file = f"{self.file_path.text()}/measurements_{timestamp}.csv"
+                    with open(self.measurement_file, 'w') as f:
+                        f.write(",".join(["X (steps)", "Y (mm)", "Z (mm)"] + meta['measurement_names']) + "\n")
+                        
+                with open(self.measurement_file, 'a') as f:
+                    f.write(",".join([str(x), f"{y:.3f}", f"{z:.3f}"] +
+                                     [repr(float(value)) for value in meta['measurements']]) + "\n")
+                self.logger.info(f"Saved measurements at position X={x}steps, Y={y:.3f}mm, Z={z:.3f}mm")
+            except Exception as e:
+                self._on_acquisition_failed(f"Failed to save measurements: {str(e)}", meta)
+                    
+        @pyqtSlot(str, object)
+        def _on_acquisition_failed(self, message, meta):
+            """Report a failed acquisition thread job."""
+            self.logger.error(f"Acquisition error: {message}")
+            if meta and meta.get('scan'):
+                if not self._is_stale(meta):
+                    self.stop_scan()
+                    QMessageBox.warning(self, "Scan Error", f"Failed to acquire data: {message}")
+            else:
+                QMessageBox.warning(self, "Acquisition Error", message)
+                
         @pyqtSlot()
         def browse_save_path(self):
             path = QFileDialog.getExistingDirectory(self, "Select Save Directory")
@@ -547,8 +965,35 @@ try:
             try:
                 self.scanning = True
                 self.current_scan_position = 0
+                self.scan_id = f"scan_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+                self.scan_path = f"{self.file_path.text()}/{self.scan_id}.tctscan"
+                self.measurement_file = None  # Created with the first measured position
+                self.feature_table = None  # Created with the first acquired position
+                if self.scan_storage.currentText() != STORAGE_PREALLOCATED:
+                    # The writer creates the file from the first point's record format
+                    channels = [channel for channel, enable in ((1, self.ch1_enable), (3, self.ch3_enable))
+                                if enable.isChecked()]
+                    compression = "zlib" if self.scan_storage.currentText() == STORAGE_COMPRESSED else None
+                    self.scan_writer = ScanWriter.create(self.scan_path, channels, metadata=self._scan_metadata(),
+                                                         compression=compression)
+                    self.logger.info(f"Writing scan to {self.scan_path}")
+                
+                # The scan starts one step from the current position along the scan axis
+                axis = "XYZ".index(self.scan_axis.currentText())
+                step = self.step_size.value() / (1.0 if axis == 0 else 1000.0)  # X in steps, Y/Z µm to mm
+                origin = list(self.stage.get_position())
+                origin[axis] += step
+                steps = [1.0, 1.0, 1.0]
+                steps[axis] = step
+                shape = [1, 1, 1]
+                shape[axis] = self.num_steps.value()
+                self.scan_grid = ScanGrid(tuple(origin), tuple(steps), tuple(shape))
+                self.reset_feature_map()
                 self.start_scan_btn.setEnabled(False)
                 self.stop_scan_btn.setEnabled(True)
+                self.num_frames.setEnabled(False)  # The first point fixes the scan file's dtype
+                self.ch1_enable.setEnabled(False)  # The scan file's channels are fixed at the start
+                self.ch3_enable.setEnabled(False)
                 
                 # Start scan timer
                 self.scan_timer.start(int(self.scan_delay.value() * 1000))
@@ -559,10 +1004,18 @@ try:
             
         @pyqtSlot()
         def stop_scan(self):
+            if self.scanning:
+                self._save_feature_table()
+                self._close_scan_file()
             self.scanning = False
             self.scan_timer.stop()
+            self.acquisition.clear_pending()
+            self.acquisition.submit(self._close_scan_store)
             self.start_scan_btn.setEnabled(True)
             self.stop_scan_btn.setEnabled(False)
+            self.num_frames.setEnabled(True)
+            self.ch1_enable.setEnabled(True)
+            self.ch3_enable.setEnabled(True)
             
         @pyqtSlot()
         def scan_step(self):
@@ -628,20 +1081,24 @@ try:
         def _acquire_after_move(self):
             """Helper method to acquire data after movement has completed."""
             try:
-                # Acquire data
-                self.acquire_data()
-                
-                # Check if scan is complete
-                self.current_scan_position += 1
-                if self.current_scan_position >= self.num_steps.value():
-                    self.stop_scan()
-                    QMessageBox.information(self, "Scan Complete", "Scan completed successfully")
+                # Queue the acquisition; _on_frame_acquired continues the scan
+                self.acquire_data(scan=True)
                 
             except Exception as e:
                 self.logger.error(f"Acquisition error: {str(e)}")
                 self.stop_scan()
                 QMessageBox.warning(self, "Scan Error", f"Failed to acquire data: {str(e)}")
                 
+        def closeEvent(self, event):
+            """Stop the acquisition thread before the window closes."""
+            self.stop_scan()
+            self.acquisition.stop()
+            # stop() drops the close job stop_scan() queued; the thread has ended now
+            self._close_scan_store()
+            if self.catalog is not None:
+                self.catalog.close()
+            super().closeEvent(event)
+            
         def update_step_size_unit(self, axis):
             """Update step size unit and range based on selected axis"""
             if axis == "X":
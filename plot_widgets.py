@@ -0,0 +1,301 @@
+import numpy as np
+from typing import NamedTuple, Optional, Sequence, Tuple
+
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+from matplotlib.figure import Figure
+from PyQt5.QtCore import QTimer
+
+from pulse_features import FeatureTable
+from waveform import Waveform, codes_to_volts
+
+AXES = ("x", "y", "z")
+
+
+def min_max_decimate(values: np.ndarray, n_bins: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Reduce a record to the minimum and maximum of each of n_bins slices.
+    
+    Unlike plain subsampling this keeps every peak and glitch visible. The
+    two samples of each slice are returned in sample order, so the result
+    still plots as a line.
+    
+    Returns:
+        (indices, values) of the kept samples; the whole record if it has
+        no more than 2 * n_bins samples
+    """
+    n_samples = len(values)
+    if n_samples <= 2 * n_bins:
+        return np.arange(n_samples), values
+        
+    bin_size = -(-n_samples // n_bins)
+    n_full = n_samples // bin_size
+    bins = values[:n_full * bin_size].reshape(n_full, bin_size)
+    indices = np.sort(np.stack([bins.argmin(axis=1), bins.argmax(axis=1)], axis=1), axis=1)
+    indices += np.arange(0, n_full * bin_size, bin_size)[:, np.newaxis]
+    indices = indices.ravel()
+    if n_full * bin_size < n_samples:
+        tail = values[n_full * bin_size:]
+        tail_indices = np.sort([tail.argmin(), tail.argmax()]) + n_full * bin_size
+        indices = np.concatenate([indices, tail_indices])
+    return indices, values[indices]
+
+
+class WaveformPlotWidget(FigureCanvas):
+    """Waveform plot for records of up to millions of samples.
+    
+    The Line2D artists are created once and updated with set_data. Each
+    line holds only a min/max decimation of the visible part of its record
+    to about two points per horizontal pixel, redone whenever the view is
+    zoomed or panned. New waveforms are only stored; a timer draws the
+    latest one at most max_fps times per second by blitting the lines onto
+    the cached axes background, so plotting never holds up acquisition.
+    Raw ADC code waveforms are decimated first and only the kept samples
+    are converted to volts.
+    """
+    
+    def __init__(self, parent=None, max_fps: float = 20.0):
+        """Initialize an empty plot.
+        
+        Args:
+            parent: Parent widget
+            max_fps: Upper limit of screen refreshes per second
+        """
+        self.figure = Figure()
+        super().__init__(self.figure)
+        self.setParent(parent)
+        self.ax = self.figure.add_subplot(111)
+        self.ax.set_xlabel("Time (s)")
+        self.ax.set_ylabel("Voltage (V)")
+        self.ax.grid(True)
+        self.lines = []
+        self.waveform: Optional[Waveform] = None
+        self._labels: Sequence[str] = ()
+        self._span: Optional[Tuple[float, float]] = None
+        self._background = None
+        self._dirty = False
+        
+        self.mpl_connect("draw_event", self._on_draw)
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.timeout.connect(self._refresh)
+        self.refresh_timer.start(int(1000 / max_fps))
+        
+    def set_waveform(self, waveform: Waveform, labels: Sequence[str] = ()):
+        """Show a waveform of one or more records with the next refresh."""
+        self.waveform = waveform
+        self._labels = labels
+        self._dirty = True
+        
+    def _records(self) -> np.ndarray:
+        return np.atleast_2d(self.waveform.voltages)
+        
+    def _create_lines(self, n_lines: int):
+        for line in self.lines:
+            line.remove()
+        self.lines = [self.ax.plot([], [], animated=True, linewidth=1,
+                                   label=self._labels[index] if index < len(self._labels) else None)[0]
+                      for index in range(n_lines)]
+        if len(self._labels):
+            self.ax.legend(loc="upper right")
+            
+    def _update_lines(self) -> Tuple[float, float]:
+        """Decimate the visible part of every record into its line.
+        
+        Returns:
+            Minimum and maximum of the drawn data
+        """
+        first, last = self.waveform.index_at(self.ax.get_xlim())
+        n_bins = max(int(self.ax.bbox.width), 1)
+        low, high = np.inf, -np.inf
+        scale = self.waveform.scale
+        if scale is not None:
+            scale = np.broadcast_to(scale, (len(self.lines), 3))
+        for index, (line, record) in enumerate(zip(self.lines, self._records())):
+            indices, values = min_max_decimate(record[first:last + 1], n_bins)
+            if scale is not None:
+                # Raw codes: only the kept samples are converted to volts
+                values = codes_to_volts(values, scale[index])
+            line.set_data(self.waveform.time_at(indices + first), values)
+            if len(values):
+                low, high = min(low, values.min()), max(high, values.max())
+        return low, high
+        
+    def _refresh(self):
+        """Draw the latest waveform, by blitting unless the axes need rescaling."""
+        if not self._dirty or self.waveform is None or self.waveform.n_samples == 0:
+            return
+        self._dirty = False
+        
+        full_redraw = False
+        if len(self.lines) != len(self._records()):
+            self._create_lines(len(self._records()))
+            full_redraw = True
+            
+        # New time axis: show the whole record and rescale the voltages
+        span = (float(self.waveform.time_at(0)), float(self.waveform.time_at(self.waveform.n_samples - 1)))
+        rescale = span != self._span
+        if rescale:
+            self._span = span
+            self.ax.set_xlim(*span)
+            
+        low, high = self._update_lines()
+        y_low, y_high = self.ax.get_ylim()
+        if np.isfinite(low) and (rescale or low < y_low or high > y_high):
+            margin = 0.1 * (high - low) or 0.1
+            self.ax.set_ylim(low - margin, high + margin)
+            full_redraw = True
+            
+        if full_redraw or rescale or self._background is None:
+            self.draw_idle()
+            return
+            
+        self.restore_region(self._background)
+        for line in self.lines:
+            self.ax.draw_artist(line)
+        self.blit(self.ax.bbox)
+        
+    def _on_draw(self, event):
+        """Cache the background after a full draw, re-decimate for the new view and draw the lines."""
+        self._background = self.copy_from_bbox(self.ax.bbox)
+        if self.waveform is None or self.waveform.n_samples == 0:
+            return
+        self._update_lines()
+        for line in self.lines:
+            self.ax.draw_artist(line)
+
+
+class ScanGrid(NamedTuple):
+    """Regular grid of stage positions, per axis X/Y/Z."""
+    origin: Tuple[float, float, float]  # Position of grid index (0, 0, 0)
+    step: Tuple[float, float, float]  # Spacing per axis; unused axes can be anything non-zero
+    shape: Tuple[int, int, int]  # Points per axis
+    
+    def index(self, positions) -> np.ndarray:
+        """Nearest grid indices of positions of shape (3,) or (n, 3)."""
+        offsets = np.asarray(positions, dtype=np.float64) - np.asarray(self.origin)
+        return np.rint(offsets / np.asarray(self.step)).astype(np.int64)
+
+
+class FeatureMapWidget(FigureCanvas):
+    """Live map of one scan feature over two of the stage axes.
+    
+    The map is a preallocated image with one pixel per grid point. A new
+    scan point writes its pixel only and marks the map dirty; a timer then
+    redraws just the image artist onto the cached background and blits it,
+    at most max_fps times per second however fast points arrive. A full
+    figure redraw happens only when the grid or the color range changes.
+    """
+    
+    def __init__(self, parent=None, max_fps: float = 25.0):
+        """Initialize an empty map.
+        
+        Args:
+            parent: Parent widget
+            max_fps: Upper limit of screen refreshes per second
+        """
+        self.figure = Figure()
+        super().__init__(self.figure)
+        self.setParent(parent)
+        self.ax = self.figure.add_subplot(111)
+        self.colorbar = None
+        self.grid: Optional[ScanGrid] = None
+        self.axes = (0, 1)  # Horizontal and vertical stage axis
+        self.image = np.full((1, 1), np.nan)
+        self.artist = None
+        self._background = None
+        self._limits = [np.inf, -np.inf]
+        self._dirty = False
+        
+        self.mpl_connect("draw_event", self._on_draw)
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.timeout.connect(self._refresh)
+        self.refresh_timer.start(int(1000 / max_fps))
+        
+    def set_grid(self, grid: ScanGrid, axes: Sequence[str] = ("x", "y"), label: str = ""):
+        """Allocate an empty map for a scan grid.
+        
+        Args:
+            grid: Positions of the scan
+            axes: Stage axes shown horizontally and vertically
+            label: Name of the mapped feature, for the color bar
+        """
+        self.grid = grid
+        self.axes = (AXES.index(axes[0]), AXES.index(axes[1]))
+        horizontal, vertical = self.axes
+        self.image = np.full((grid.shape[vertical], grid.shape[horizontal]), np.nan)
+        self._limits = [np.inf, -np.inf]
+        
+        # Pixel centers sit on the grid positions
+        extent = []
+        for axis in self.axes:
+            first = grid.origin[axis] - grid.step[axis] / 2
+            extent += [first, first + grid.shape[axis] * grid.step[axis]]
+            
+        self.figure.clear()
+        self.ax = self.figure.add_subplot(111)
+        self.artist = self.ax.imshow(self.image, origin="lower", extent=extent, aspect="auto",
+                                     interpolation="nearest", animated=True)
+        self.ax.set_xlabel(AXES[horizontal].upper())
+        self.ax.set_ylabel(AXES[vertical].upper())
+        self.colorbar = self.figure.colorbar(self.artist, ax=self.ax, label=label)
+        self.draw_idle()
+        
+    def add_point(self, position: Sequence[float], value: float):
+        """Write one scan point's pixel; shown with the next refresh."""
+        if self.grid is None or not np.isfinite(value):
+            return
+        index = self.grid.index(position)
+        column, row = index[self.axes[0]], index[self.axes[1]]
+        if not (0 <= row < self.image.shape[0] and 0 <= column < self.image.shape[1]):
+            return
+            
+        self.image[row, column] = value
+        self._dirty = True
+        if value < self._limits[0] or value > self._limits[1]:
+            self._limits = [min(value, self._limits[0]), max(value, self._limits[1])]
+            self._set_limits()
+            
+    def load(self, table: FeatureTable, feature: str):
+        """Fill the map from all rows of a feature table at once, e.g. after switching feature."""
+        if self.grid is None:
+            return
+        self.image.fill(np.nan)
+        self._limits = [np.inf, -np.inf]
+        self.colorbar.set_label(feature)
+        if len(table) and feature in table.columns:
+            positions = np.column_stack([table[axis] for axis in AXES])
+            index = self.grid.index(positions)
+            columns, rows = index[:, self.axes[0]], index[:, self.axes[1]]
+            values = table[feature]
+            inside = ((rows >= 0) & (rows < self.image.shape[0]) &
+                      (columns >= 0) & (columns < self.image.shape[1]) & np.isfinite(values))
+            self.image[rows[inside], columns[inside]] = values[inside]
+            if inside.any():
+                self._limits = [values[inside].min(), values[inside].max()]
+        self._set_limits()
+        
+    def _set_limits(self):
+        """Apply the color range; this needs a full redraw for the color bar."""
+        low, high = self._limits
+        if not np.isfinite(low):
+            return
+        if low == high:
+            low, high = low - 0.5, high + 0.5
+        self.artist.set_clim(low, high)
+        self._dirty = False
+        self.draw_idle()
+        
+    def _on_draw(self, event):
+        """Cache the freshly drawn background, then draw the animated image on it."""
+        self._background = self.copy_from_bbox(self.ax.bbox)
+        if self.artist is not None:
+            self.artist.set_data(self.image)
+            self.ax.draw_artist(self.artist)
+            
+    def _refresh(self):
+        """Blit the image if pixels were written since the last refresh."""
+        if not self._dirty or self._background is None or self.artist is None:
+            return
+        self._dirty = False
+        self.restore_region(self._background)
+        self.artist.set_data(self.image)
+        self.ax.draw_artist(self.artist)
+        self.blit(self.ax.bbox)
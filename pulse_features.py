@@ -0,0 +1,182 @@
+import numpy as np
+from typing import Dict, NamedTuple, Optional, Sequence, Tuple
+
+from waveform import Waveform
+
+
+class PulseFeatures(NamedTuple):
+    """Per-waveform TCT pulse features, one array element per waveform."""
+    baseline: np.ndarray  # Mean of the pre-trigger region (V)
+    noise: np.ndarray  # RMS of the pre-trigger region around the baseline (V)
+    amplitude: np.ndarray  # Peak height above the baseline (V)
+    peak_time: np.ndarray  # Time of the peak sample (s)
+    charge: np.ndarray  # Integral of the pulse over the charge window (V*s)
+    rise_time: np.ndarray  # 10-90% leading edge rise time (s)
+    arrival_time: np.ndarray  # Constant-fraction time of arrival (s)
+
+
+FEATURE_NAMES = PulseFeatures._fields
+
+
+def _leading_edge_crossing(pulses: np.ndarray, levels: np.ndarray,
+                           before_peak: np.ndarray) -> np.ndarray:
+    """Fractional sample index where each pulse last rises through its level before the peak.
+    
+    Args:
+        pulses: Baseline-subtracted records, shape (n, samples)
+        levels: One level per record, shape (n,)
+        before_peak: Mask of the samples preceding each record's peak
+        
+    Returns:
+        Interpolated crossing index per record, NaN where there is none
+    """
+    n_waveforms, n_samples = pulses.shape
+    below = pulses < levels[:, np.newaxis]
+    below &= before_peak
+    
+    # Last sample below the level: first True of the reversed rows
+    last_below = n_samples - 1 - below[:, ::-1].argmax(axis=1)
+    rows = np.arange(n_waveforms)
+    found = below[rows, last_below]
+    
+    # Interpolate linearly between the sample below and the one above the level
+    after = np.minimum(last_below + 1, n_samples - 1)
+    low = pulses[rows, last_below]
+    high = pulses[rows, after]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fraction = (levels - low) / (high - low)
+    crossing = last_below + fraction
+    crossing[~found] = np.nan
+    return crossing
+
+
+def extract_features(voltages: np.ndarray, xin: float, xze: float = 0.0, pt_off: float = 0.0,
+                     baseline_samples: Optional[int] = None,
+                     charge_window: Optional[Tuple[float, float]] = None,
+                     cf_fraction: float = 0.5, polarity: int = 1) -> PulseFeatures:
+    """Compute pulse features of many waveforms at once.
+    
+    Every step works on the whole (n, samples) block with NumPy; there is
+    no Python loop over waveforms.
+    
+    Args:
+        voltages: Records of shape (n, samples), or a single (samples,) record
+        xin: Sample interval in seconds
+        xze: Time of sample pt_off in seconds
+        pt_off: Sample index that xze refers to
+        baseline_samples: Samples at the start of each record used for the
+            baseline and noise; if None, the samples before the trigger
+            (t < 0), or the first tenth of the record if there are too few
+        charge_window: (t_start, t_stop) in seconds to integrate over; if
+            None, everything after the baseline region
+        cf_fraction: Fraction of the amplitude that defines the arrival time
+        polarity: 1 for positive pulses, -1 for negative ones; features are
+            reported for the inverted signal, so amplitudes stay positive
+            
+    Returns:
+        PulseFeatures with arrays of shape (n,)
+    """
+    voltages = np.asarray(voltages)
+    if voltages.ndim == 1:
+        voltages = voltages[np.newaxis]
+    n_waveforms, n_samples = voltages.shape
+    
+    def index_at(time):
+        return int(np.clip(np.ceil((time - xze) / xin + pt_off), 0, n_samples))
+        
+    def time_at(index):
+        return (index - pt_off) * xin + xze
+        
+    if baseline_samples is None:
+        baseline_samples = index_at(0.0)
+        if baseline_samples < 4:
+            baseline_samples = max(n_samples // 10, 1)
+    baseline_samples = min(baseline_samples, n_samples)
+    
+    # Baseline-subtracted pulses in float64, in one new array
+    pre_trigger = voltages[:, :baseline_samples]
+    baseline = pre_trigger.mean(axis=1, dtype=np.float64)
+    noise = pre_trigger.std(axis=1, dtype=np.float64)
+    pulses = voltages - baseline[:, np.newaxis]
+    if polarity < 0:
+        np.negative(pulses, out=pulses)
+        
+    peak = pulses.argmax(axis=1)
+    rows = np.arange(n_waveforms)
+    amplitude = pulses[rows, peak]
+    
+    if charge_window is None:
+        start, stop = baseline_samples, n_samples
+    else:
+        start, stop = index_at(charge_window[0]), index_at(charge_window[1])
+    charge = pulses[:, start:stop].sum(axis=1) * xin
+    
+    before_peak = np.arange(n_samples) < peak[:, np.newaxis]
+    t10 = _leading_edge_crossing(pulses, 0.1 * amplitude, before_peak)
+    t90 = _leading_edge_crossing(pulses, 0.9 * amplitude, before_peak)
+    t_cf = _leading_edge_crossing(pulses, cf_fraction * amplitude, before_peak)
+    
+    return PulseFeatures(
+        baseline=baseline,
+        noise=noise,
+        amplitude=amplitude,
+        peak_time=time_at(peak),
+        charge=charge,
+        rise_time=(t90 - t10) * xin,
+        arrival_time=time_at(t_cf),
+    )
+
+
+def waveform_features(waveform: Waveform, **kwargs) -> PulseFeatures:
+    """extract_features() on the records of a Waveform, using its time axis."""
+    waveform = waveform.in_volts()
+    return extract_features(waveform.voltages, waveform.xin, waveform.xze, waveform.pt_off, **kwargs)
+
+
+class FeatureTable:
+    """Growable columnar table of per-position scan results.
+    
+    Each column is a contiguous float64 array, so a column can be handed
+    to NumPy or a plot as a view without copying. Capacity doubles when
+    full, so appending a row is amortized O(1). Missing values are NaN.
+    """
+    
+    def __init__(self, columns: Sequence[str], capacity: int = 1024):
+        """Initialize an empty table.
+        
+        Args:
+            columns: Column names, e.g. ("x", "y", "z", "ch1_charge")
+            capacity: Rows to allocate up front
+        """
+        self.columns = tuple(columns)
+        self._index = {name: index for index, name in enumerate(self.columns)}
+        self._data = np.full((len(self.columns), max(capacity, 1)), np.nan)
+        self._length = 0
+        
+    def __len__(self) -> int:
+        return self._length
+        
+    def __getitem__(self, name: str) -> np.ndarray:
+        """View of one column's filled rows."""
+        return self._data[self._index[name], :self._length]
+        
+    def append(self, values: Dict[str, float]):
+        """Add one row; columns missing from values are NaN, unknown names are an error."""
+        if self._length == self._data.shape[1]:
+            grown = np.full((len(self.columns), 2 * self._length), np.nan)
+            grown[:, :self._length] = self._data
+            self._data = grown
+            
+        row = self._length
+        for name, value in values.items():
+            self._data[self._index[name], row] = value
+        self._length += 1
+        
+    def as_dict(self) -> Dict[str, np.ndarray]:
+        """All columns as views, keyed by name."""
+        return {name: self[name] for name in self.columns}
+        
+    def save_csv(self, filename: str):
+        """Write the table with a header row of column names."""
+        np.savetxt(filename, self._data[:, :self._length].T, delimiter=',',
+                   header=','.join(self.columns), comments='')
@@ -0,0 +1,924 @@
+import atexit
+import json
+import logging
+import lzma
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from waveform import Waveform, codes_to_volts
+
+# File starts with the magic and the byte length of the JSON header that
+# follows; the header is padded to HEADER_SIZE so it can be rewritten in place
+MAGIC = b"TCTSCAN\x00"
+VERSION = 1
+HEADER_SIZE = 64 * 1024
+_PREFIX = struct.Struct("<8sQ")
+
+# Chunk compression codecs: (compress(data, level), decompress(data)).
+# Both release the GIL, so chunks compress in parallel on a thread pool.
+CODECS = {
+    "zlib": (lambda data, level: zlib.compress(data, level), zlib.decompress),
+    "lzma": (lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+}
+
+# Entry of the chunk index of a compressed file, and the byte length
+# written in front of every blob
+_INDEX_DTYPE = np.dtype([("offset", "<u8"), ("nbytes", "<u8")])
+_BLOB_PREFIX = struct.Struct("<Q")
+
+
+def point_dtype(n_channels: int) -> np.dtype:
+    """Per-point table record: stage position, time and per-channel (ymu, yoff, yze)."""
+    return np.dtype([
+        ("position", "<f8", (3,)),
+        ("timestamp", "<f8"),
+        ("scale", "<f8", (n_channels, 3)),
+    ])
+
+
+def delta_encode(codes: np.ndarray) -> np.ndarray:
+    """Differences between neighbouring samples of each record.
+    
+    A flat baseline turns into runs of small values that compress far
+    better than the codes. Integer overflow wraps around, so
+    delta_decode() restores the codes exactly.
+    """
+    deltas = np.empty_like(codes)
+    deltas[..., 0] = codes[..., 0]
+    np.subtract(codes[..., 1:], codes[..., :-1], out=deltas[..., 1:])
+    return deltas
+
+
+def delta_decode(deltas: np.ndarray) -> np.ndarray:
+    """Inverse of delta_encode()."""
+    return np.cumsum(deltas, axis=-1, dtype=deltas.dtype)
+
+
+class ScanFile:
+    """Single-file container for all waveforms of one scan.
+    
+    The file holds a (points, channels, samples) dataset of raw codes, a
+    table with the position, timestamp and per-channel scaling of every
+    point, and free-form scan metadata in a JSON header. Storing the
+    int8/int16 codes the scope sends keeps every bit of information at
+    1-2 bytes per sample; volts are computed only when read_volts() or
+    Waveform.in_volts() asks for them.
+    
+    Points are grouped in chunks of ``chunk_size``. Every chunk has a fixed
+    size and holds the rows of the point table of its points followed by
+    their codes, shape (chunk_size, channels, samples), so appending a
+    point and reading any point are both O(1) seeks, and the file ends
+    right after the last record written. Layout::
+    
+        MAGIC | header length | JSON header (padded to HEADER_SIZE)
+        chunk 0: points[chunk_size] | codes[chunk_size, channels, samples]
+        chunk 1: ...
+        
+    Compressed files store each full chunk as one zlib or lzma blob of
+    its point rows and delta-encoded codes, appended in order after the
+    header, each preceded by its byte length. close() writes a chunk
+    index of (offset, nbytes) per chunk after the last blob, followed by
+    the whole point table uncompressed, so positions and scaling are read
+    without decompressing any chunk. While the file is still being
+    written, readers find the blobs by following the lengths instead.
+    Either way any point can be read by decompressing just its chunk.
+    Chunks are compressed on a thread pool while the next chunk fills; a
+    partly filled last chunk is written by close(). Layout::
+    
+        MAGIC | header length | JSON header (padded to HEADER_SIZE)
+        length 0 | blob 0 | length 1 | blob 1 | ... | index[chunks] | points[n_points]
+        
+    Create files with ScanFile.create() and open them with ScanFile.open().
+    """
+    
+    def __init__(self, path: str, header: Dict[str, Any], writable: bool):
+        self.path = path
+        self.header = header
+        self.writable = writable
+        self.dtype = np.dtype(header["dtype"])
+        self.point_dtype = point_dtype(len(header["channels"]))
+        self._file = open(path, "r+b" if writable else "rb")
+        self._memmaps: Dict[int, Tuple[np.ndarray, np.ndarray]] = {}
+        
+        # Compressed files: chunk index, end of the last blob, chunks not
+        # on disk yet (filling or compressing), the point rows of the
+        # chunks handed to compression and the last chunk read
+        self._index: List[Tuple[int, int]] = []
+        self._end = HEADER_SIZE
+        self._unwritten: Dict[int, Tuple[np.ndarray, np.ndarray]] = {}
+        self._submitted_points: List[np.ndarray] = []
+        self._compressing: deque = deque()
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._max_compressing = 0
+        self._decoded: Tuple[Optional[int], Any] = (None, None)
+        
+    @classmethod
+    def create(cls, path: str, channels: Sequence[int], n_samples: int, dtype,
+               timebase: Tuple[float, float, float], chunk_size: int = 64,
+               metadata: Optional[Dict[str, Any]] = None,
+               capacity: Optional[int] = None, compression: Optional[str] = None,
+               level: int = 1, workers: Optional[int] = None, overwrite: bool = True) -> "ScanFile":
+        """Create an empty scan file, by default replacing any existing one.
+        
+        With a capacity, e.g. the number of points of the scan plan, the
+        file is allocated at its full size up front as one chunk. The whole
+        dataset is then a single (capacity, channels, samples) array that
+        memmap() maps without copies, also while the scan is running.
+        
+        Args:
+            path: File to create
+            channels: Scope channel numbers, in dataset order
+            n_samples: Samples per record
+            dtype: Sample dtype of the stored codes, e.g. int8
+            timebase: (xze, xin, pt_off) shared by all records
+            chunk_size: Points per chunk
+            metadata: JSON-serializable scan settings to keep with the data
+            capacity: Number of points to preallocate; the file cannot
+                grow beyond it
+            compression: Codec from CODECS to compress the chunks with,
+                or None to store them as they are
+            level: Compression level, zlib 0-9 or lzma preset 0-9
+            workers: Compression threads, by default one per CPU
+            overwrite: Replace an existing file at path; if False, raise
+                FileExistsError instead
+        """
+        if compression is not None:
+            if compression not in CODECS:
+                raise ValueError(f"Unknown compression {compression!r}, expected one of {list(CODECS)}")
+            if capacity is not None:
+                raise ValueError("Preallocated scan files cannot be compressed")
+        if capacity is not None:
+            chunk_size = capacity
+        header = {
+            "version": VERSION,
+            "channels": [int(channel) for channel in channels],
+            "n_samples": int(n_samples),
+            "dtype": np.dtype(dtype).str,
+            "timebase": [float(value) for value in timebase],
+            "chunk_size": int(chunk_size),
+            "n_points": 0,
+            "created": time.time(),
+            "capacity": capacity,
+            "compression": compression,
+            "level": int(level),
+            "delta": compression is not None and bool(np.issubdtype(dtype, np.integer)),
+            "index_offset": None,  # Set by close()
+            "points_offset": None,  # Set by close()
+            "metadata": metadata or {},
+        }
+        with open(path, "wb" if overwrite else "xb"):
+            pass
+        scan = cls(path, header, writable=True)
+        scan._write_header()
+        if capacity is not None:
+            scan._file.truncate(scan._chunk_offset(1))
+        if compression is not None:
+            workers = workers or os.cpu_count() or 1
+            scan._pool = ThreadPoolExecutor(workers, thread_name_prefix="ScanCompress")
+            scan._max_compressing = 2 * workers
+        return scan
+        
+    @classmethod
+    def open(cls, path: str, writable: bool = False) -> "ScanFile":
+        """Open an existing scan file, by default read-only."""
+        header = cls._read_header(path)
+        if header["version"] > VERSION:
+            raise ValueError(f"{path} has unsupported version {header['version']}")
+        if writable and header.get("compression") is not None:
+            raise IOError(f"{path} is compressed and cannot be appended to")
+        scan = cls(path, header, writable)
+        scan.refresh()
+        return scan
+        
+    @property
+    def channels(self) -> List[int]:
+        return self.header["channels"]
+        
+    @property
+    def n_channels(self) -> int:
+        return len(self.header["channels"])
+        
+    @property
+    def n_samples(self) -> int:
+        return self.header["n_samples"]
+        
+    @property
+    def n_points(self) -> int:
+        return self.header["n_points"]
+        
+    @property
+    def chunk_size(self) -> int:
+        return self.header["chunk_size"]
+        
+    @property
+    def timebase(self) -> Tuple[float, float, float]:
+        return tuple(self.header["timebase"])
+        
+    @property
+    def metadata(self) -> Dict[str, Any]:
+        return self.header["metadata"]
+        
+    @property
+    def capacity(self) -> Optional[int]:
+        """Preallocated number of points, None for a growing file."""
+        return self.header.get("capacity")
+        
+    @property
+    def compression(self) -> Optional[str]:
+        """Chunk codec, None for an uncompressed file."""
+        return self.header.get("compression")
+        
+    def __len__(self) -> int:
+        return self.n_points
+        
+    @property
+    def record_shape(self) -> Tuple[int, int]:
+        return self.n_channels, self.n_samples
+        
+    @property
+    def _record_bytes(self) -> int:
+        return self.n_channels * self.n_samples * self.dtype.itemsize
+        
+    @property
+    def _chunk_bytes(self) -> int:
+        return self.chunk_size * (self._record_bytes + self.point_dtype.itemsize)
+        
+    def _chunk_offset(self, chunk: int) -> int:
+        return HEADER_SIZE + chunk * self._chunk_bytes
+        
+    def _point_offset(self, index: int) -> int:
+        chunk, slot = divmod(index, self.chunk_size)
+        return self._chunk_offset(chunk) + slot * self.point_dtype.itemsize
+        
+    def _codes_offset(self, index: int) -> int:
+        chunk, slot = divmod(index, self.chunk_size)
+        return (self._chunk_offset(chunk) + self.chunk_size * self.point_dtype.itemsize +
+                slot * self._record_bytes)
+                
+    @property
+    def _stored_points(self) -> int:
+        """Points of a compressed file that are in blobs on disk."""
+        return min(len(self._index) * self.chunk_size, self.n_points)
+        
+    @staticmethod
+    def _read_header(path: str) -> Dict[str, Any]:
+        with open(path, "rb") as f:
+            magic, length = _PREFIX.unpack(f.read(_PREFIX.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a scan file")
+            return json.loads(f.read(length))
+            
+    def _write_header(self):
+        header = self.header
+        if self.compression is not None:
+            # Readers only get to see the points in the indexed blobs
+            header = dict(header, n_points=self._stored_points)
+        encoded = json.dumps(header).encode()
+        if _PREFIX.size + len(encoded) > HEADER_SIZE:
+            raise ValueError(f"Scan header of {len(encoded)} bytes does not fit in {HEADER_SIZE}")
+        self._file.seek(0)
+        self._file.write(_PREFIX.pack(MAGIC, len(encoded)))
+        self._file.write(encoded.ljust(HEADER_SIZE - _PREFIX.size, b" "))
+        
+    def _check_index(self, index: int) -> int:
+        if index < 0:
+            index += self.n_points
+        if not 0 <= index < self.n_points:
+            raise IndexError(f"Point {index} out of range for {self.n_points} points")
+        return index
+        
+    def _make_point(self, position: Sequence[float], scale: Optional[np.ndarray],
+                    timestamp: Optional[float]) -> np.ndarray:
+        point = np.zeros((), dtype=self.point_dtype)
+        point["position"] = position
+        point["timestamp"] = time.time() if timestamp is None else timestamp
+        if scale is None:
+            point["scale"][:, 0] = 1.0
+        else:
+            point["scale"] = scale
+        return point
+        
+    def _next_index(self) -> int:
+        if not self.writable:
+            raise IOError(f"{self.path} is open read-only")
+        if self.capacity is not None and self.n_points >= self.capacity:
+            raise IndexError(f"{self.path} is full ({self.capacity} points)")
+        return self.n_points
+        
+    def append(self, codes: np.ndarray, position: Sequence[float],
+               scale: Optional[np.ndarray] = None, timestamp: Optional[float] = None) -> int:
+        """Add the records of one point at the end of the scan.
+        
+        Args:
+            codes: Records of shape (channels, samples), cast to the file's dtype
+            position: Stage position (x, y, z)
+            scale: Per-channel (ymu, yoff, yze), shape (channels, 3);
+                identity scaling if None
+            timestamp: Acquisition time in seconds since the epoch; now if None
+            
+        Returns:
+            Index of the new point
+        """
+        index = self._next_index()
+        codes = np.ascontiguousarray(codes, dtype=self.dtype)
+        if codes.shape != self.record_shape:
+            raise ValueError(f"Expected records of shape {self.record_shape}, got {codes.shape}")
+            
+        point = self._make_point(position, scale, timestamp)
+        if self.compression is not None:
+            self._append_compressed(index, point, codes)
+        else:
+            self._file.seek(self._point_offset(index))
+            self._file.write(point.tobytes())
+            self._file.seek(self._codes_offset(index))
+            self._file.write(codes.data)
+        self.header["n_points"] = index + 1
+        return index
+        
+    def _append_compressed(self, index: int, point: np.ndarray, codes: np.ndarray):
+        """Add a point to its chunk in memory; a full chunk goes to the compression pool."""
+        chunk, slot = divmod(index, self.chunk_size)
+        if chunk not in self._unwritten:
+            self._unwritten[chunk] = (np.zeros(self.chunk_size, dtype=self.point_dtype),
+                                      np.empty((self.chunk_size,) + self.record_shape, dtype=self.dtype))
+        points, chunk_codes = self._unwritten[chunk]
+        points[slot] = point
+        chunk_codes[slot] = codes
+        if slot == self.chunk_size - 1:
+            self._submit_chunk(chunk, self.chunk_size)
+            
+    def _submit_chunk(self, chunk: int, count: int):
+        points, codes = self._unwritten[chunk]
+        self._submitted_points.append(points[:count])
+        self._compressing.append(self._pool.submit(self._compress_chunk, chunk, points[:count], codes[:count]))
+        # Limit the chunks held in memory when compression falls behind
+        self._write_chunks(self._max_compressing)
+        
+    def _compress_chunk(self, chunk: int, points: np.ndarray, codes: np.ndarray) -> Tuple[int, bytes]:
+        """Runs on the compression pool."""
+        if self.header["delta"]:
+            codes = delta_encode(codes)
+        compress = CODECS[self.compression][0]
+        return chunk, compress(points.tobytes() + codes.tobytes(), self.header["level"])
+        
+    def _write_chunks(self, max_pending: Optional[int] = None):
+        """Write the compressed chunks that are done, in order.
+        
+        Args:
+            max_pending: Also wait for the oldest chunks until no more than
+                this many are still compressing
+        """
+        while self._compressing and (self._compressing[0].done() or
+                                     (max_pending is not None and len(self._compressing) > max_pending)):
+            chunk, blob = self._compressing.popleft().result()
+            self._file.seek(self._end)
+            self._file.write(_BLOB_PREFIX.pack(len(blob)))
+            self._file.write(blob)
+            self._index.append((self._end + _BLOB_PREFIX.size, len(blob)))
+            self._end += _BLOB_PREFIX.size + len(blob)
+            del self._unwritten[chunk]
+            
+    def _load_index(self):
+        """Find the blobs of the chunks that hold the header's n_points."""
+        n_chunks = -(-self.n_points // self.chunk_size)
+        if self.header["index_offset"] is not None:
+            self._file.seek(self.header["index_offset"])
+            index = np.frombuffer(self._file.read(n_chunks * _INDEX_DTYPE.itemsize), dtype=_INDEX_DTYPE)
+            self._index = [(int(offset), int(nbytes)) for offset, nbytes in index]
+            return
+        # Still being written: follow the blob lengths from the last known blob
+        offset = self._index[-1][0] + self._index[-1][1] if self._index else HEADER_SIZE
+        while len(self._index) < n_chunks:
+            self._file.seek(offset)
+            nbytes, = _BLOB_PREFIX.unpack(self._file.read(_BLOB_PREFIX.size))
+            self._index.append((offset + _BLOB_PREFIX.size, nbytes))
+            offset += _BLOB_PREFIX.size + nbytes
+        
+    def _read_chunk(self, chunk: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Point rows and codes of one chunk of a compressed file, decompressing it if needed."""
+        if chunk in self._unwritten:
+            return self._unwritten[chunk]
+        if self._decoded[0] != chunk:
+            offset, nbytes = self._index[chunk]
+            self._file.seek(offset)
+            data = CODECS[self.compression][1](self._file.read(nbytes))
+            count = len(data) // (self.point_dtype.itemsize + self._record_bytes)
+            points = np.frombuffer(data, dtype=self.point_dtype, count=count)
+            codes = np.frombuffer(data, dtype=self.dtype, offset=count * self.point_dtype.itemsize)
+            codes = codes.reshape((count,) + self.record_shape)
+            if self.header["delta"]:
+                codes = delta_decode(codes)
+            self._decoded = (chunk, (points, codes))
+        return self._decoded[1]
+        
+    def memmap(self, chunk: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+        """Map one chunk into memory without reading it.
+        
+        Returns:
+            (points, codes) arrays of shape (chunk_size,) and (chunk_size,
+            channels, samples) backed by the file; for a preallocated file
+            chunk 0 is the whole scan. Only rows below n_points are valid.
+        """
+        if self.compression is not None:
+            raise ValueError(f"{self.path} is compressed and cannot be memory-mapped")
+        if chunk not in self._memmaps:
+            mode = "r+" if self.writable else "r"
+            offset = self._chunk_offset(chunk)
+            if self.writable:
+                # Make sure the chunk exists in the file before mapping it
+                self._file.seek(0, 2)
+                if self._file.tell() < offset + self._chunk_bytes:
+                    self._file.truncate(offset + self._chunk_bytes)
+            points = np.memmap(self.path, dtype=self.point_dtype, mode=mode,
+                               offset=offset, shape=(self.chunk_size,))
+            codes = np.memmap(self.path, dtype=self.dtype, mode=mode,
+                              offset=offset + self.chunk_size * self.point_dtype.itemsize,
+                              shape=(self.chunk_size,) + self.record_shape)
+            self._memmaps[chunk] = (points, codes)
+        return self._memmaps[chunk]
+        
+    def reserve(self) -> Tuple[int, np.ndarray]:
+        """Writable view of the next point's records, to decode a transfer straight into.
+        
+        The point only becomes part of the scan with commit().
+        
+        Returns:
+            (index, codes) where codes has shape (channels, samples)
+        """
+        index = self._next_index()
+        chunk, slot = divmod(index, self.chunk_size)
+        return index, self.memmap(chunk)[1][slot]
+        
+    def commit(self, index: int, position: Sequence[float],
+               scale: Optional[np.ndarray] = None, timestamp: Optional[float] = None):
+        """Add the point whose records were written into the view from reserve().
+        
+        The point table row is written last, so a reader that sees a
+        timestamp also sees the complete records.
+        """
+        if index != self._next_index():
+            raise ValueError(f"Point {index} was not reserved, next point is {self.n_points}")
+        chunk, slot = divmod(index, self.chunk_size)
+        self.memmap(chunk)[0][slot] = self._make_point(position, scale, timestamp)
+        self.header["n_points"] = index + 1
+        
+    def refresh(self):
+        """Pick up points added by a writer since the file was opened.
+        
+        Preallocated files are checked through the point table, which is
+        filled as each point is committed; others through the header, which
+        the writer updates on flush().
+        """
+        if self.writable:
+            return
+        if self.capacity is None:
+            header = self._read_header(self.path)
+            self.header["n_points"] = header["n_points"]
+            if self.compression is not None:
+                self.header["index_offset"] = header["index_offset"]
+                self.header["points_offset"] = header.get("points_offset")
+                self._load_index()
+        else:
+            committed = self.memmap()[0]["timestamp"] > 0
+            self.header["n_points"] = int(committed.argmin()) if not committed.all() else len(committed)
+            
+    @property
+    def n_chunks(self) -> int:
+        return -(-self.n_points // self.chunk_size)
+        
+    def read_chunk(self, chunk: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Point rows and codes of all points in one chunk.
+        
+        Codes of an uncompressed file are a read-only memory map of the
+        file; of a compressed file, the decompressed chunk.
+        
+        Returns:
+            (points, codes) of shape (count,) and (count, channels, samples)
+        """
+        if not 0 <= chunk < self.n_chunks:
+            raise IndexError(f"Chunk {chunk} out of range for {self.n_chunks} chunks")
+        count = min(self.chunk_size, self.n_points - chunk * self.chunk_size)
+        if self.compression is not None:
+            points, codes = self._read_chunk(chunk)
+            return points[:count], codes[:count]
+        if self.capacity is not None:
+            points, codes = self.memmap()
+            return points[:count], codes[:count]
+        start = chunk * self.chunk_size
+        self._file.seek(self._point_offset(start))
+        points = np.frombuffer(self._file.read(count * self.point_dtype.itemsize), dtype=self.point_dtype)
+        codes = np.memmap(self.path, dtype=self.dtype, mode="r", offset=self._codes_offset(start),
+                          shape=(count,) + self.record_shape)
+        return points, codes
+        
+    def read_codes(self, index: int) -> np.ndarray:
+        """Stored records of one point, shape (channels, samples)."""
+        index = self._check_index(index)
+        if self.compression is not None:
+            chunk, slot = divmod(index, self.chunk_size)
+            return self._read_chunk(chunk)[1][slot]
+        self._file.seek(self._codes_offset(index))
+        data = self._file.read(self._record_bytes)
+        return np.frombuffer(data, dtype=self.dtype).reshape(self.record_shape)
+        
+    def read_volts(self, index: int) -> np.ndarray:
+        """Records of one point converted to volts, shape (channels, samples)."""
+        return codes_to_volts(self.read_codes(index), self.read_point(index)["scale"])
+        
+    def read_waveform(self, index: int) -> Waveform:
+        """Records of one point as a raw-code Waveform; in_volts() converts it."""
+        return Waveform(self.read_codes(index), *self.timebase, scale=self.read_point(index)["scale"])
+        
+    def read_point(self, index: int) -> np.void:
+        """Point table row of one point (position, timestamp, scale)."""
+        index = self._check_index(index)
+        if self.compression is not None:
+            chunk, slot = divmod(index, self.chunk_size)
+            return self._read_chunk(chunk)[0][slot]
+        self._file.seek(self._point_offset(index))
+        return np.frombuffer(self._file.read(self.point_dtype.itemsize), dtype=self.point_dtype)[0]
+        
+    def points(self) -> np.ndarray:
+        """The whole point table.
+        
+        Of a compressed file that is still being written, the table is
+        only in the chunks, so every chunk is decompressed.
+        """
+        if self.compression is not None and self.header.get("points_offset") is not None:
+            self._file.seek(self.header["points_offset"])
+            data = self._file.read(self.n_points * self.point_dtype.itemsize)
+            return np.frombuffer(data, dtype=self.point_dtype).copy()
+        table = np.empty(self.n_points, dtype=self.point_dtype)
+        for start in range(0, self.n_points, self.chunk_size):
+            count = min(self.chunk_size, self.n_points - start)
+            if self.compression is not None:
+                table[start:start + count] = self._read_chunk(start // self.chunk_size)[0][:count]
+                continue
+            self._file.seek(self._point_offset(start))
+            data = self._file.read(count * self.point_dtype.itemsize)
+            table[start:start + count] = np.frombuffer(data, dtype=self.point_dtype)
+        return table
+        
+    @property
+    def positions(self) -> np.ndarray:
+        """Stage positions of all points, shape (points, 3)."""
+        return self.points()["position"]
+        
+    def flush(self):
+        """Write the header and buffered data so readers see every appended point.
+        
+        Of a compressed file, readers see the chunks whose compression has
+        finished; the rest is written by a later flush() or by close().
+        """
+        if self.writable:
+            if self.compression is not None:
+                self._write_chunks()
+            self._write_header()
+        self._file.flush()
+        
+    def close(self):
+        if self._file.closed:
+            return
+        if self.writable and self.compression is not None:
+            # The last chunk may be partly filled
+            chunk, count = divmod(self.n_points, self.chunk_size)
+            if count:
+                self._submit_chunk(chunk, count)
+            self._write_chunks(0)
+            self._pool.shutdown()
+            # No blob follows anymore, so the index and point table can go at the end
+            self._file.seek(self._end)
+            self._file.write(np.array(self._index, dtype=_INDEX_DTYPE).tobytes())
+            self.header["index_offset"] = self._end
+            self.header["points_offset"] = self._file.tell()
+            for points in self._submitted_points:
+                self._file.write(points.tobytes())
+        self.flush()
+        for points, codes in self._memmaps.values():
+            if self.writable:
+                codes.flush()
+                points.flush()
+        self._memmaps.clear()
+        self._file.close()
+        
+    def __enter__(self) -> "ScanFile":
+        return self
+        
+    def __exit__(self, *exc_info):
+        self.close()
+        
+    def __repr__(self) -> str:
+        return (f"ScanFile({self.path!r}, points={self.n_points}, channels={self.channels}, "
+                f"samples={self.n_samples}, dtype={self.dtype})")
+
+
+class ScanWriter:
+    """Background thread that appends points to a ScanFile.
+    
+    write() only queues the point, so the caller (the scan loop) can move
+    the stage and trigger the next acquisition while the disk works. The
+    thread takes everything that is waiting, up to batch_size points, and
+    appends it with one flush of the header at the end of the batch.
+    
+    The queue holds at most max_pending points; when the disk falls that
+    far behind, write() blocks until there is room again (back-pressure),
+    or raises queue.Full if it must not block, e.g. on a GUI thread.
+    close() writes every queued point before closing the file and is also
+    run at interpreter exit. An error on the writer thread is raised again
+    by the next write(), flush() or close().
+    
+    A writer from create() is started before the record format is known:
+    it creates its file from the first point written.
+    """
+    
+    def __init__(self, scan: Optional[ScanFile], max_pending: int = 32, batch_size: int = 16):
+        """Start the writer thread.
+        
+        Args:
+            scan: Writable scan file; the writer owns it until close().
+                None for create(), which sets up the file's creation
+            max_pending: Points that may wait in the queue
+            batch_size: Most points appended per header flush
+        """
+        self.scan = scan
+        self.path = scan.path if scan is not None else None
+        self.batch_size = batch_size
+        self.logger = logging.getLogger(__name__)
+        self._create: Optional[Callable[[np.ndarray, Tuple[float, float, float]], ScanFile]] = None
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue(maxsize=max_pending)
+        self._error: Optional[BaseException] = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="ScanWriter", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+        
+    @classmethod
+    def create(cls, path: str, channels: Sequence[int], max_pending: int = 32,
+               batch_size: int = 16, **kwargs) -> "ScanWriter":
+        """Start a writer for a new scan file, before its first point is acquired.
+        
+        The path is claimed right away, so an existing file is never
+        replaced. The writer thread creates the scan file in it with the
+        number of samples, dtype and timebase of the first point written;
+        if no point is written, close() removes the empty file again.
+        
+        Args:
+            path: Scan file to create
+            channels: Scope channel numbers, in dataset order
+            max_pending: Points that may wait in the queue
+            batch_size: Most points appended per header flush
+            kwargs: Further ScanFile.create() arguments, e.g. metadata or compression
+            
+        Raises:
+            FileExistsError: If path exists already
+        """
+        with open(path, "xb"):
+            pass
+        writer = cls(None, max_pending, batch_size)
+        writer.path = path
+        writer._create = lambda codes, timebase: ScanFile.create(
+            path, channels, codes.shape[-1], codes.dtype, timebase, **kwargs)
+        return writer
+        
+    def write(self, codes: np.ndarray, position: Sequence[float],
+              scale: Optional[np.ndarray] = None, timestamp: Optional[float] = None,
+              timebase: Optional[Tuple[float, float, float]] = None,
+              block: bool = True, timeout: Optional[float] = None):
+        """Queue one point for ScanFile.append(), by default blocking while the queue is full.
+        
+        The arrays are written later and must not be modified afterwards.
+        
+        Args:
+            timebase: (xze, xin, pt_off) of the records; a writer from
+                create() needs it to create its file
+            block: Wait for room in the queue, at most timeout seconds
+            
+        Raises:
+            queue.Full: If the queue is full and block is False, or the
+                timeout expired before there was room
+        """
+        self._raise_error()
+        if self._closed:
+            raise IOError(f"Writer for {self.path} is closed")
+        if self._create is not None and timebase is None:
+            raise ValueError(f"The first point of {self.path} needs its timebase")
+        self._queue.put((codes, position, scale, timestamp, timebase), block, timeout)
+        
+    def flush(self):
+        """Wait until every queued point is written and visible to readers."""
+        self._queue.join()
+        self._raise_error()
+        
+    def close(self):
+        """Write the remaining points, stop the thread and close the file."""
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        self._queue.put(None)
+        self._thread.join()
+        if self.scan is not None:
+            self.scan.close()
+        elif self.path is not None:
+            os.remove(self.path)
+        self._raise_error()
+        
+    @property
+    def pending(self) -> int:
+        """Points queued but not written yet."""
+        return self._queue.qsize()
+        
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+            
+    def _run(self):
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+                    
+            try:
+                for item in batch:
+                    if item is None:
+                        running = False
+                    elif self._error is None:
+                        codes, position, scale, timestamp, timebase = item
+                        if self.scan is None:
+                            self.scan = self._create(codes, timebase)
+                        self.scan.append(codes, position, scale, timestamp)
+                if self.scan is not None:
+                    self.scan.flush()
+            except Exception as e:
+                self.logger.error(f"Error writing to {self.path}: {str(e)}")
+                self._error = e
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+
+class ScanReader:
+    """Random access to a stored scan by grid index, for analysis.
+    
+    The grid axes are the distinct stage coordinates of the points, so
+    ``reader[ix, iy, iz, ch]`` addresses a record by its position's rank
+    along X, Y and Z. Each index can be an integer, a slice or a list,
+    like NumPy indexing; the result has one dimension per non-integer
+    index plus the sample dimension. A single record of an uncompressed
+    file is a view of a memory map, nothing is read until it is used.
+    
+    Compressed chunks are decompressed when first needed and kept in an
+    LRU cache of at most cache_bytes, so stepping through neighbouring
+    points decompresses each chunk once. batches() walks the whole scan
+    chunk by chunk for out-of-core analysis.
+    """
+    
+    def __init__(self, path: str, cache_bytes: int = 256 * 1024 * 1024, volts: bool = False,
+                 decimals: int = 6):
+        """Open a scan file read-only and index its positions.
+        
+        Args:
+            path: Scan file
+            cache_bytes: Memory cap of the decompressed chunk cache
+            volts: Return records in volts instead of raw codes; this
+                always copies
+            decimals: Coordinates that agree to this many decimals are
+                the same grid position
+        """
+        self.scan = ScanFile.open(path)
+        self.cache_bytes = cache_bytes
+        self.volts = volts
+        self._cache: "OrderedDict[int, Tuple[np.ndarray, np.ndarray]]" = OrderedDict()
+        self._cached_bytes = 0
+        
+        # Point table of the whole scan; a closed compressed file stores it
+        # uncompressed, so records are only decompressed when first used
+        self.points = self.scan.points()
+        positions = np.round(self.points["position"], decimals)
+        self.coordinates = []
+        grid_index = []
+        for axis in range(3):
+            values, inverse = np.unique(positions[:, axis], return_inverse=True)
+            self.coordinates.append(values)
+            grid_index.append(inverse.ravel())
+        self.grid = np.full([len(values) for values in self.coordinates], -1, dtype=np.int64)
+        self.grid[tuple(grid_index)] = np.arange(len(self.points))
+        
+    @property
+    def shape(self) -> Tuple[int, int, int, int, int]:
+        """(nx, ny, nz, channels, samples)"""
+        return self.grid.shape + self.scan.record_shape
+        
+    def __len__(self) -> int:
+        return len(self.points)
+        
+    def _chunk(self, chunk: int) -> Tuple[np.ndarray, np.ndarray]:
+        """One chunk's points and codes through the LRU cache."""
+        if chunk in self._cache:
+            self._cache.move_to_end(chunk)
+            return self._cache[chunk]
+        points, codes = self.scan.read_chunk(chunk)
+        self._cache[chunk] = (points, codes)
+        # Memory maps take no memory of their own
+        if not isinstance(codes, np.memmap):
+            self._cached_bytes += codes.nbytes
+        while self._cached_bytes > self.cache_bytes and len(self._cache) > 1:
+            _, (_, evicted) = self._cache.popitem(last=False)
+            if not isinstance(evicted, np.memmap):
+                self._cached_bytes -= evicted.nbytes
+        return points, codes
+        
+    def record(self, index: int) -> np.ndarray:
+        """Records of one point by point index, shape (channels, samples)."""
+        if not 0 <= index < len(self):
+            raise IndexError(f"Point {index} out of range for {len(self)} points")
+        chunk, slot = divmod(index, self.scan.chunk_size)
+        codes = self._chunk(chunk)[1][slot]
+        if self.volts:
+            return codes_to_volts(codes, self.points[index]["scale"])
+        return codes
+        
+    def waveform(self, ix: int, iy: int, iz: int) -> Waveform:
+        """Records of one grid position as a raw-code Waveform; in_volts() converts it."""
+        index = self._point_at((ix, iy, iz))
+        chunk, slot = divmod(index, self.scan.chunk_size)
+        return Waveform(self._chunk(chunk)[1][slot], *self.scan.timebase,
+                        scale=self.points[index]["scale"])
+                        
+    def _point_at(self, grid_index) -> int:
+        index = int(self.grid[grid_index])
+        if index < 0:
+            raise KeyError(f"No point was stored at grid index {grid_index}")
+        return index
+        
+    def __getitem__(self, key) -> np.ndarray:
+        """Records by grid index, ``reader[ix, iy, iz, ch]``; missing trailing indices select all."""
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 4:
+            raise IndexError(f"At most 4 indices (ix, iy, iz, ch), got {len(key)}")
+        key = key + (slice(None),) * (4 - len(key))
+        grid_key, channel = key[:3], key[3]
+        
+        if all(isinstance(value, (int, np.integer)) for value in grid_key):
+            return self.record(self._point_at(grid_key))[channel]
+            
+        indices = self.grid[grid_key]
+        if (indices < 0).any():
+            raise KeyError(f"No point was stored at some of the grid indices {grid_key}")
+        first = self.record(int(indices.flat[0]))[channel]
+        out = np.empty(indices.shape + first.shape, dtype=first.dtype)
+        flat = out.reshape((indices.size,) + first.shape)
+        # Visit the points in file order so each chunk is loaded once
+        order = np.argsort(indices, axis=None, kind="stable")
+        for position in order:
+            flat[position] = self.record(int(indices.flat[position]))[channel]
+        return out
+        
+    def batches(self, size: Optional[int] = None):
+        """Iterate over the scan in file order, a few points at a time.
+        
+        Args:
+            size: Points per batch; by default one chunk, which needs no
+                copying
+                
+        Yields:
+            (points, codes) of shape (n,) and (n, channels, samples), in
+            raw codes whatever ``volts`` is
+        """
+        size = size or self.scan.chunk_size
+        for start in range(0, len(self), size):
+            stop = min(start + size, len(self))
+            parts = []
+            for chunk in range(start // self.scan.chunk_size, (stop - 1) // self.scan.chunk_size + 1):
+                chunk_start = chunk * self.scan.chunk_size
+                _, codes = self._chunk(chunk)
+                parts.append(codes[max(start - chunk_start, 0):stop - chunk_start])
+            yield self.points[start:stop], parts[0] if len(parts) == 1 else np.concatenate(parts)
+            
+    def close(self):
+        self._cache.clear()
+        self.scan.close()
+        
+    def __enter__(self) -> "ScanReader":
+        return self
+        
+    def __exit__(self, *exc_info):
+        self.close()
+        
+    def __repr__(self) -> str:
+        return f"ScanReader({self.scan.path!r}, shape={self.shape}, dtype={self.scan.dtype})"
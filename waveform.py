@@ -0,0 +1,120 @@
+import numpy as np
+from typing import Iterator, Optional, Tuple
+
+
+def codes_to_volts(codes: np.ndarray, scale: np.ndarray) -> np.ndarray:
+    """Convert raw ADC codes to volts as (code - yoff) * ymu + yze.
+    
+    Args:
+        codes: Records with samples along the last axis, e.g. (channels, samples)
+        scale: (ymu, yoff, yze) along the last axis, one per record, e.g.
+            shape (channels, 3), or (3,) for all records
+            
+    Returns:
+        New float64 array of the same shape as codes
+    """
+    scale = np.asarray(scale, dtype=np.float64)
+    volts = codes.astype(np.float64)
+    volts -= scale[..., 1:2]
+    volts *= scale[..., 0:1]
+    volts += scale[..., 2:3]
+    return volts
+
+
+class Waveform:
+    """Waveform record with an implicit, uniformly sampled time axis.
+    
+    Only X-zero and X-increment are stored; the time axis is computed when
+    it is asked for. The sample data can be one record of shape (samples,)
+    or several records sharing the time axis, shape (channels, samples).
+    
+    The samples can also be raw ADC codes with their per-record scaling
+    in ``scale``; in_volts() then converts them when they are needed.
+    
+    For compatibility with code expecting a (times, voltages) tuple, a
+    Waveform unpacks as ``times, voltages = waveform``.
+    """
+    
+    def __init__(self, voltages: np.ndarray, xze: float, xin: float, pt_off: float = 0.0,
+                 scale: Optional[np.ndarray] = None):
+        """Initialize the waveform.
+        
+        Args:
+            voltages: Sample data, samples along the last axis
+            xze: Time of sample pt_off in seconds (X-zero)
+            xin: Sample interval in seconds (X-increment)
+            pt_off: Sample index that xze refers to
+            scale: None if the samples are volts; for raw ADC codes, the
+                (ymu, yoff, yze) of each record, shape (3,) or (channels, 3)
+        """
+        self.voltages = voltages
+        self.xze = xze
+        self.xin = xin
+        self.pt_off = pt_off
+        self.scale = None if scale is None else np.asarray(scale, dtype=np.float64)
+        
+    @classmethod
+    def empty(cls) -> "Waveform":
+        """Waveform without samples, returned when an acquisition fails."""
+        return cls(np.array([]), 0.0, 0.0)
+        
+    @property
+    def timebase(self) -> Tuple[float, float, float]:
+        """(xze, xin, pt_off), enough to rebuild the time axis."""
+        return self.xze, self.xin, self.pt_off
+        
+    @property
+    def n_samples(self) -> int:
+        return self.voltages.shape[-1] if self.voltages.ndim else 0
+        
+    @property
+    def times(self) -> np.ndarray:
+        """Time axis in seconds, computed on every access."""
+        return self.time_slice(0, self.n_samples)
+        
+    def time_slice(self, start: int, stop: int, step: int = 1) -> np.ndarray:
+        """Times of the samples start:stop:step without building the whole axis."""
+        times = np.arange(start, stop, step, dtype=np.float64)
+        times -= self.pt_off
+        times *= self.xin
+        times += self.xze
+        return times
+        
+    def time_at(self, index):
+        """Time of sample index (scalar or array)."""
+        return (np.asarray(index) - self.pt_off) * self.xin + self.xze
+        
+    def index_at(self, time, clip: bool = True):
+        """Nearest sample index of a time (scalar or array)."""
+        index = np.rint((np.asarray(time) - self.xze) / self.xin + self.pt_off).astype(np.int64)
+        if clip:
+            index = np.clip(index, 0, max(self.n_samples - 1, 0))
+        return index
+        
+    @property
+    def is_raw(self) -> bool:
+        """Whether the samples are raw ADC codes rather than volts."""
+        return self.scale is not None
+        
+    def in_volts(self) -> "Waveform":
+        """This waveform with samples in volts, converting raw codes if needed."""
+        if self.scale is None:
+            return self
+        return Waveform(codes_to_volts(self.voltages, self.scale), *self.timebase)
+        
+    def channel(self, index: int) -> "Waveform":
+        """One record of a multi-channel waveform, sharing the time axis."""
+        scale = None if self.scale is None else self.scale[index]
+        return Waveform(self.voltages[index], *self.timebase, scale=scale)
+        
+    def with_data(self, voltages: np.ndarray) -> "Waveform":
+        """New waveform with other sample data on the same time axis."""
+        return Waveform(voltages, *self.timebase)
+        
+    def __iter__(self) -> Iterator[np.ndarray]:
+        yield self.times
+        yield self.voltages
+        
+    def __repr__(self) -> str:
+        return (f"Waveform(shape={self.voltages.shape}, xze={self.xze!r}, "
+                f"xin={self.xin!r}, pt_off={self.pt_off!r}, raw={self.is_raw})")
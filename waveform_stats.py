@@ -0,0 +1,100 @@
+import numpy as np
+from typing import Optional
+
+
+class WaveformAccumulator:
+    """Streaming per-sample statistics over many shots of one waveform.
+    
+    Keeps the running mean, variance (Welford/Chan), minimum and maximum of
+    every sample in float64 without storing the shots themselves, so memory
+    stays O(samples) however many shots are added. Raw int8/int16 codes can
+    be accumulated directly and the results scaled to volts afterwards with
+    scope_controller.scale_codes().
+    """
+    
+    def __init__(self, n_samples: Optional[int] = None):
+        """Initialize an empty accumulator.
+        
+        Args:
+            n_samples: Samples per shot; taken from the first update if None
+        """
+        self.count = 0
+        self.mean: Optional[np.ndarray] = None
+        self.m2: Optional[np.ndarray] = None  # Sum of squared deviations
+        self.min: Optional[np.ndarray] = None
+        self.max: Optional[np.ndarray] = None
+        if n_samples is not None:
+            self._allocate(n_samples)
+            
+    def _allocate(self, n_samples: int):
+        self.mean = np.zeros(n_samples, dtype=np.float64)
+        self.m2 = np.zeros(n_samples, dtype=np.float64)
+        self.min = np.full(n_samples, np.inf)
+        self.max = np.full(n_samples, -np.inf)
+        
+    def update(self, frames: np.ndarray) -> "WaveformAccumulator":
+        """Add one shot of shape (samples,) or a batch of shape (n, samples).
+        
+        A batch, such as a FastFrame block, is reduced with one NumPy pass
+        and merged in, rather than being added shot by shot.
+        """
+        frames = np.asarray(frames)
+        if frames.ndim == 1:
+            frames = frames[np.newaxis]
+        n_batch = len(frames)
+        if n_batch == 0:
+            return self
+            
+        batch_mean = frames.mean(axis=0, dtype=np.float64)
+        if n_batch > 1:
+            deviations = frames - batch_mean
+            batch_m2 = np.einsum("ij,ij->j", deviations, deviations)
+        else:
+            batch_m2 = np.zeros_like(batch_mean)
+            
+        self._combine(n_batch, batch_mean, batch_m2, frames.min(axis=0), frames.max(axis=0))
+        return self
+        
+    def merge(self, other: "WaveformAccumulator") -> "WaveformAccumulator":
+        """Fold in the statistics of another accumulator, e.g. from another thread."""
+        if other.count:
+            self._combine(other.count, other.mean, other.m2, other.min, other.max)
+        return self
+        
+    def _combine(self, n_other: int, mean_other: np.ndarray, m2_other: np.ndarray,
+                 min_other: np.ndarray, max_other: np.ndarray):
+        """Combine with another partial result (Chan et al. parallel update)."""
+        if self.mean is None:
+            self._allocate(len(mean_other))
+        elif len(mean_other) != len(self.mean):
+            raise ValueError(f"Expected {len(self.mean)} samples per shot, "
+                             f"got {len(mean_other)}")
+            
+        total = self.count + n_other
+        delta = mean_other - self.mean
+        self.m2 += m2_other
+        self.m2 += delta * delta * (self.count * n_other / total)
+        delta *= n_other / total
+        self.mean += delta
+        np.minimum(self.min, min_other, out=self.min)
+        np.maximum(self.max, max_other, out=self.max)
+        self.count = total
+        
+    def variance(self, ddof: int = 1) -> np.ndarray:
+        """Per-sample variance with ``ddof`` delta degrees of freedom."""
+        if self.count <= ddof:
+            return np.full_like(self.m2, np.nan) if self.m2 is not None else np.array([])
+        return self.m2 / (self.count - ddof)
+        
+    def std(self, ddof: int = 1) -> np.ndarray:
+        """Per-sample standard deviation."""
+        return np.sqrt(self.variance(ddof))
+        
+    def reset(self):
+        """Forget all shots while keeping the allocated arrays."""
+        self.count = 0
+        if self.mean is not None:
+            self.mean.fill(0)
+            self.m2.fill(0)
+            self.min.fill(np.inf)
+            self.max.fill(-np.inf)